@@ -1,3 +1,6 @@
 from ._plot_pipeline_matrix import plot_pipeline_matrix, get_exported_pipelines, get_pipeline_profiler_html
 from ._demodata import get_heartstatlog_data
-from ._import_autosklearn import import_autosklearn
\ No newline at end of file
+from ._import_autosklearn import import_autosklearn
+from ._merge_cache import get_merge_cache_info
+from ._js_bundle import reset_js_bundle, set_inline_bundle_once
+from ._plot_registry import set_max_registered_plots
@@ -1,25 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import sys
+import threading
+import traceback
+import numpy as np
+
+COMM_WORKERS = 4 # worker threads running asynchronous comm handlers
+
+# Numpy arrays in replies are sent as binary buffers (Jupyter) or base64 strings (Colab), and replaced in the reply by
+# {'__ndarray__': {'dtype': ..., 'shape': [...], 'buffer': <index in the message buffers>}} or
+# {'__ndarray__': {'dtype': ..., 'shape': [...], 'base64': ...}}. The javascript CommAPI decodes them as TypedArrays
+# (a list of row subarrays for 2d arrays). Dtypes without TypedArray are converted to int32 or float64.
+BUFFER_DTYPES = ('float64', 'float32', 'int32', 'uint32', 'int16', 'uint16', 'int8', 'uint8')
+
+_executor = None
+_latest_requests = {} # (api_call_id, comm id) -> future of the last asynchronous request
+_latest_lock = threading.Lock()
+
+def get_comm_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=COMM_WORKERS)
+    return _executor
+
+def to_buffer_array(array):
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    elif array.dtype.name not in BUFFER_DTYPES:
+        int32 = np.iinfo(np.int32)
+        fits_int32 = array.dtype.kind in 'iu' and (array.size == 0 or (array.min() >= int32.min and array.max() <= int32.max))
+        array = array.astype(np.int32 if fits_int32 else np.float64)
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+
+def encode_arrays(data, buffers=None):
+    # Replaces the numpy arrays of data (in dicts and lists) by their description. Their bytes are appended to buffers,
+    # or written in base64 if buffers is None
+    if isinstance(data, np.ndarray):
+        array = to_buffer_array(data)
+        description = {'dtype': array.dtype.name, 'shape': list(array.shape)}
+        if buffers is None:
+            description['base64'] = base64.b64encode(array.tobytes()).decode('ascii')
+        else:
+            description['buffer'] = len(buffers)
+            buffers.append(memoryview(array))
+        return {'__ndarray__': description}
+    if isinstance(data, dict):
+        return {key: encode_arrays(value, buffers) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [encode_arrays(value, buffers) for value in data]
+    return data
+
+def encode_reply(ret, binary=True):
+    # Returns the reply without numpy arrays, and the buffers with their bytes (empty if binary is False)
+    buffers = [] if binary else None
+    return encode_arrays(ret, buffers), buffers or []
+
+def send_comm_reply(comm, ret):
+    data, buffers = encode_reply(ret)
+    comm.send(data, buffers=buffers)
+
+def tag_reply(msg, ret):
+    # Replies carry the request_id of their request (set by the javascript CommAPI), so stale replies can be ignored
+    if isinstance(ret, dict) and isinstance(msg, dict) and 'request_id' in msg:
+        ret = dict(ret, request_id=msg['request_id'])
+    return ret
+
+def dispatch_latest(key, callback, msg, send):
+    # Runs callback(msg) on the worker pool and sends its reply, unless a newer request with the same key was received
+    # in the meantime. A superseded request is cancelled if it has not started yet, its reply is dropped otherwise.
+    with _latest_lock:
+        previous = _latest_requests.get(key)
+        if previous is not None:
+            previous.cancel()
+        future = get_comm_executor().submit(callback, msg)
+        _latest_requests[key] = future
+    future.add_done_callback(lambda done: send_latest_reply(key, done, msg, send))
+
+def send_latest_reply(key, future, msg, send):
+    if future.cancelled():
+        return
+    with _latest_lock:
+        if _latest_requests.get(key) is not future:
+            return # superseded
+        del _latest_requests[key]
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        return
+    send(tag_reply(msg, future.result()))
+
 def setup_comm_colab(api_call_id, callback):
     # Function that connects javascript call with Colab Notebook
+    # Colab runs the calls one at a time, superseded calls are dropped by the javascript CommAPI before being sent
     from google.colab import output
     from IPython import display
     def _recv(msg):
-        return display.JSON(callback(msg)) # Use display.JSON to transfer an object
+        data, _ = encode_reply(tag_reply(msg, callback(msg)), binary=False)
+        return display.JSON(data) # Use display.JSON to transfer an object
     output.register_callback(api_call_id, _recv)
 
-def setup_comm_jupyter(api_call_id, callback): 
+def setup_comm_jupyter(api_call_id, callback, asynchronous=False):
     # Function that connects javascript call with Jupyter Notebook
-    def _comm_api(comm, open_msg): 
+    # asynchronous: callback runs on a worker thread, only the last request of each plot (comm) is answered
+    def _comm_api(comm, open_msg):
         @comm.on_msg
         def _recv(msg):
-            ret = callback(msg['content']['data'])
-            comm.send(ret)
+            data = msg['content']['data']
+            if asynchronous:
+                dispatch_latest((api_call_id, comm.comm_id), callback, data, lambda ret: send_comm_reply(comm, ret))
+            else:
+                send_comm_reply(comm, tag_reply(data, callback(data)))
     get_ipython().kernel.comm_manager.register_target(api_call_id, _comm_api)
 
-def setup_comm_api(api_call_id, callback):
+def setup_comm_api(api_call_id, callback, asynchronous=False):
     # Function that abstracts notebook connection to javascript
+    # asynchronous: for slow handlers whose requests are superseded by newer ones (the frontend CommAPI must be
+    # created with latestOnly)
     try:
         jupyter_setup = True
-        setup_comm_jupyter(api_call_id, callback)
+        setup_comm_jupyter(api_call_id, callback, asynchronous=asynchronous)
     except Exception:
         jupyter_setup = False
     try:
@@ -28,4 +127,4 @@ def setup_comm_api(api_call_id, callback):
     except Exception:
         colab_setup = False
     if not jupyter_setup and not colab_setup:
-        print("Error: Cannot find Jupyter/Colab namespace for Python")
\ No newline at end of file
+        print("Error: Cannot find Jupyter/Colab namespace for Python")
@@ -0,0 +1,122 @@
+import json
+import numpy as np
+
+#####
+# Compact columnar format of the pipeline matrix data (see prepare_data_pipeline_matrix), decoded by
+# js/compactPayload.js.
+#
+# Repeated values (primitives, steps, hyperparameters and any other pipeline field) are stored once in tables and
+# referenced by index, and scores are stored as dense pipelines x metrics matrices:
+#
+# {
+#   "format": "compact",
+#   "infos": ..., "module_types": ...,
+#   "pipelines": {
+#     "n": <number of pipelines>,
+#     "metrics": [<metric name>, ...],
+#     "values": [[<value of metric j for pipeline i, or null>, ...], ...],
+#     "normalized": [[<normalized value of metric j for pipeline i, or null>, ...], ...],
+#     "primitives": [<step['primitive']>, ...],
+#     "steps": [<step without hyperparams, with "primitive" replaced by its index>, ...],
+#     "step_indices": [[<index of step j of pipeline i>, ...], ...],
+#     "hyperparams": [<step['hyperparams']>, ...], # only if include_hyperparams
+#     "hyperparam_indices": [[<index of the hyperparams of step j of pipeline i, or -1>, ...], ...],
+#     "columns": {<key>: {"values": [...], "index": [<index of pipeline[key], or -1 if missing>, ...]}}
+#   }
+# }
+#
+# With numeric_arrays, "values" and "normalized" are float64 numpy arrays (NaN if missing) and the column indexes are
+# int32 numpy arrays, sent as binary buffers by the comm api (see _comm_api.encode_reply).
+
+
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+_key_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def make_table():
+    # Returns a list of distinct values and a function adding a value to it and returning its index
+    values = []
+    codes = {}
+    def intern(value):
+        key = (type(value), value) if isinstance(value, SCALAR_TYPES) else _key_encoder.encode(value)
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(values)
+            values.append(value)
+        return code
+    return values, intern
+
+
+def to_score_matrix(rows, n_metrics):
+    # Float64 matrix of the scores, or the rows as they are if some score is not a number
+    try:
+        return np.array(rows, dtype=np.float64).reshape(len(rows), n_metrics)
+    except (TypeError, ValueError):
+        return rows
+
+
+def encode_compact_payload(data, include_hyperparams=True, numeric_arrays=False):
+    pipelines = data['pipelines']
+    primitives, intern_primitive = make_table()
+    steps, intern_step = make_table()
+    hyperparams, intern_hyperparams = make_table()
+    step_codes = {} # encoded step -> (step index, hyperparams index), steps are often repeated across pipelines
+    step_indices = []
+    hyperparam_indices = []
+    for pipeline in pipelines:
+        pipeline_steps = []
+        pipeline_hyperparams = []
+        for step in pipeline['steps']:
+            key = _key_encoder.encode(step)
+            codes = step_codes.get(key)
+            if codes is None:
+                template = {key: value for key, value in step.items() if key != 'hyperparams'}
+                template['primitive'] = intern_primitive(step['primitive'])
+                codes = step_codes[key] = (
+                    intern_step(template),
+                    intern_hyperparams(step['hyperparams']) if 'hyperparams' in step else -1
+                )
+            pipeline_steps.append(codes[0])
+            pipeline_hyperparams.append(codes[1])
+        step_indices.append(pipeline_steps)
+        hyperparam_indices.append(pipeline_hyperparams)
+
+    metrics = {}
+    for pipeline in pipelines:
+        for name in pipeline['score_map']:
+            metrics.setdefault(name, len(metrics))
+    values = [[None] * len(metrics) for _ in pipelines]
+    normalized = [[None] * len(metrics) for _ in pipelines]
+    for row, pipeline in enumerate(pipelines):
+        for name, score in pipeline['score_map'].items():
+            values[row][metrics[name]] = score.get('value')
+            normalized[row][metrics[name]] = score.get('normalized')
+
+    columns = {}
+    for key in sorted({key for pipeline in pipelines for key in pipeline} - {'steps', 'scores', 'score_map'}):
+        column_values, intern_value = make_table()
+        index = [intern_value(pipeline[key]) if key in pipeline else -1 for pipeline in pipelines]
+        columns[key] = {'values': column_values, 'index': np.array(index, dtype=np.int32) if numeric_arrays else index}
+
+    if numeric_arrays:
+        values = to_score_matrix(values, len(metrics))
+        normalized = to_score_matrix(normalized, len(metrics))
+
+    compact_pipelines = {
+        'n': len(pipelines),
+        'metrics': list(metrics),
+        'values': values,
+        'normalized': normalized,
+        'primitives': primitives,
+        'steps': steps,
+        'step_indices': step_indices,
+        'hyperparam_indices': hyperparam_indices,
+        'columns': columns,
+    }
+    if include_hyperparams:
+        compact_pipelines['hyperparams'] = hyperparams
+    compact = {key: value for key, value in data.items() if key != 'pipelines'}
+    compact['format'] = 'compact'
+    compact['pipelines'] = compact_pipelines
+    return compact
@@ -1,6 +1,8 @@
 import networkx as nx
 import numpy as np
+from scipy import sparse
 from scipy.optimize import linear_sum_assignment
+from ._parallel import resolve_n_jobs, make_executor
 from ._similarity_flooding import similarity_flooding
 
 #####
@@ -14,6 +16,14 @@ from ._similarity_flooding import similarity_flooding
 # merged = merge_multiple_graphs(pipelines[:3])
 # plot_merged_pipeline(merged)
 
+# Similarity flooding of the node similarities before matching. Previous versions ran it but discarded its result, and
+# using it with the parameters below merges pipelines poorly, so it is disabled until they are tuned.
+# `similarity_flooding(..., return_stats=True)` reports the number of iterations run and the final residual.
+SIMILARITY_FLOODING = False
+FLOODING_ALPHA = 0.1
+FLOODING_N_ITER = 50
+FLOODING_TOL = 1e-6
+
 
 def graph_data_accessor(node, graph_name):
     if 'hyperparams' in node:
@@ -65,25 +75,57 @@ def python_path_similarity(python_path1, python_path2):
         else:
             return 0
 
+def encode_node_paths(g, path_codes, family_codes):
+    # Encodes the python paths of every node of g, and their family (`split('.')[2]`), as integers.
+    # Paths without a family are given their own family code, so they only match themselves.
+    # Returns (node index, path code, family code) arrays with one entry per node data
+    node_idx, paths, families = [], [], []
+    for idx, node in enumerate(g.nodes):
+        for data in g.nodes[node]['data']:
+            python_path = data['python_path']
+            split = python_path.split(".")
+            family = split[2] if len(split) > 2 else (python_path,)
+            node_idx.append(idx)
+            paths.append(path_codes.setdefault(python_path, len(path_codes)))
+            families.append(family_codes.setdefault(family, len(family_codes)))
+    return np.array(node_idx, dtype=np.intp), np.array(paths, dtype=np.intp), np.array(families, dtype=np.intp)
+
 def compute_node_similarity_matrix(g1, g2):
-    similarity = np.zeros([len(g1.nodes), len(g2.nodes)])
-    for idx_g1, n_g1 in enumerate(g1.nodes):
-        for idx_g2, n_g2 in enumerate(g2.nodes):
-            datas1 = g1.nodes[n_g1]['data']
-            datas2 = g2.nodes[n_g2]['data']
-            similarities = []
-            for data1 in datas1: # Node can have multiple primitives. Computing the max average similarity
-                for data2 in datas2:
-                    python_path1 = data1['python_path']
-                    python_path2 = data2['python_path']
-                    path_similarity = python_path_similarity(python_path1, python_path2)
-                    # small hack to consider "neighborhood" (TODO: replace similarity flooding)
-                    n_g1_proc = '.'.join(n_g1.split(".")[-2:])
-                    n_g2_proc = '.'.join(n_g2.split(".")[-2:])
-                    if n_g1_proc == n_g2_proc:
-                        path_similarity += 0.05
-                    similarities.append(path_similarity)
-            similarity[idx_g1, idx_g2] = np.mean(similarities)
+    # Average python_path_similarity between the primitives merged into each pair of nodes, plus 0.05 for nodes
+    # with the same name suffix.
+    # The similarity of a pair of primitives is 0.5 * (same path + same family), so the average is computed from
+    # the number of pairs of primitives with the same path and with the same family.
+    path_codes, family_codes = {}, {}
+    node_idx_g1, paths_g1, families_g1 = encode_node_paths(g1, path_codes, family_codes)
+    node_idx_g2, paths_g2, families_g2 = encode_node_paths(g2, path_codes, family_codes)
+    n_data_g1 = np.bincount(node_idx_g1, minlength=len(g1.nodes))
+    n_data_g2 = np.bincount(node_idx_g2, minlength=len(g2.nodes))
+    def count_matrix(node_idx, codes, n_nodes, n_codes):
+        return sparse.csr_matrix((np.ones(len(codes)), (node_idx, codes)), shape=(n_nodes, n_codes))
+    n_g1, n_g2 = len(g1.nodes), len(g2.nodes)
+    same_path = (count_matrix(node_idx_g1, paths_g1, n_g1, len(path_codes)) @ count_matrix(node_idx_g2, paths_g2, n_g2, len(path_codes)).T).toarray()
+    same_family = (count_matrix(node_idx_g1, families_g1, n_g1, len(family_codes)) @ count_matrix(node_idx_g2, families_g2, n_g2, len(family_codes)).T).toarray()
+    similarity = 0.5 * (same_path + same_family) / np.outer(n_data_g1, n_data_g2)
+
+    # small hack to consider "neighborhood" (TODO: replace similarity flooding)
+    suffix_codes = {}
+    suffixes_g1 = np.array([suffix_codes.setdefault('.'.join(n.split(".")[-2:]), len(suffix_codes)) for n in g1.nodes])
+    suffixes_g2 = np.array([suffix_codes.setdefault('.'.join(n.split(".")[-2:]), len(suffix_codes)) for n in g2.nodes])
+    # Averages shifted by 0.05 are rounded depending on the order of the terms. Averaging them term by term, like
+    # the pairwise computation, for every group of node pairs with the same number of primitives
+    starts_g1 = np.cumsum(n_data_g1) - n_data_g1
+    starts_g2 = np.cumsum(n_data_g2) - n_data_g2
+    pairs_g1, pairs_g2 = np.nonzero(suffixes_g1[:, None] == suffixes_g2[None, :])
+    pair_shapes = n_data_g1[pairs_g1] * (n_data_g2.max() + 1) + n_data_g2[pairs_g2]
+    for pair_shape in np.unique(pair_shapes):
+        group = pair_shapes == pair_shape
+        idx_g1, idx_g2 = pairs_g1[group], pairs_g2[group]
+        data_g1 = starts_g1[idx_g1][:, None] + np.arange(n_data_g1[idx_g1[0]])
+        data_g2 = starts_g2[idx_g2][:, None] + np.arange(n_data_g2[idx_g2[0]])
+        same_path = paths_g1[data_g1][:, :, None] == paths_g2[data_g2][:, None, :]
+        same_family = families_g1[data_g1][:, :, None] == families_g2[data_g2][:, None, :]
+        similarities = 0.5 * (same_path.astype(int) + same_family) + 0.05
+        similarity[idx_g1, idx_g2] = np.mean(similarities.reshape(len(idx_g1), -1), axis=1)
     return similarity
 
 def compute_edit_cost_matrix(similarity_matrix, add_cost, del_cost):
@@ -106,36 +148,120 @@ def compute_edit_cost_matrix(similarity_matrix, add_cost, del_cost):
     return cost_matrix
 
 
+class ContractionGraph:
+    # Directed acyclic graph over integer nodes supporting in place node contractions that keep it acyclic.
+    # Contracted nodes are tracked with a union-find, and a topological order is maintained incrementally
+    # (Pearce-Kelly), so checking whether a contraction creates a cycle only searches the nodes between the two
+    # contracted nodes in the current order.
+
+    def __init__(self, n_nodes, edges):
+        self.parent = list(range(n_nodes))
+        self.successors = [set() for _ in range(n_nodes)]
+        self.predecessors = [set() for _ in range(n_nodes)]
+        for source, dest in edges:
+            self.successors[source].add(dest)
+            self.predecessors[dest].add(source)
+        helper = nx.DiGraph()
+        helper.add_nodes_from(range(n_nodes))
+        helper.add_edges_from(edges)
+        self.order = [0] * n_nodes
+        for position, node in enumerate(nx.topological_sort(helper)):
+            self.order[node] = position
+
+    def find(self, node):
+        root = node
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[node] != root:
+            self.parent[node], node = root, self.parent[node]
+        return root
+
+    def search(self, start, end, neighbors, in_bounds):
+        # Nodes reachable from `start` within the order bounds, ignoring the direct edge between `start` and `end`.
+        # Returns None if `end` is reached through another node.
+        visited = {start}
+        stack = [n for n in neighbors[start] if n != end and in_bounds(n)]
+        while stack:
+            node = stack.pop()
+            if node == end:
+                return None
+            if node in visited:
+                continue
+            visited.add(node)
+            stack.extend(n for n in neighbors[node] if n not in visited and in_bounds(n))
+        return visited
+
+    def contract(self, u, v):
+        # Contracts v into u (removing self loops) unless it creates a cycle. Returns whether it was contracted.
+        u, v = self.find(u), self.find(v)
+        if u == v:
+            return True
+        low, high = (u, v) if self.order[u] < self.order[v] else (v, u)
+        order_low, order_high = self.order[low], self.order[high]
+        after_low = self.search(low, high, self.successors, lambda n: self.order[n] <= order_high)
+        if after_low is None:
+            return False
+        before_high = self.search(high, low, self.predecessors, lambda n: self.order[n] >= order_low)
+        if before_high is None:
+            return False
+
+        # Nodes before `high` keep preceding the contracted node and nodes after `low` keep following it
+        after_low.discard(low)
+        before_high.discard(high)
+        before_high = sorted(before_high, key=self.order.__getitem__)
+        after_low = sorted(after_low, key=self.order.__getitem__)
+        slots = sorted(self.order[n] for n in before_high + [low, high] + after_low)
+        for node, slot in zip(before_high + [u] + after_low, slots):
+            self.order[node] = slot
+
+        self.parent[v] = u
+        for dest in self.successors[v]:
+            self.predecessors[dest].discard(v)
+            if dest != u:
+                self.predecessors[dest].add(u)
+                self.successors[u].add(dest)
+        for source in self.predecessors[v]:
+            self.successors[source].discard(v)
+            if source != u:
+                self.successors[source].add(u)
+                self.predecessors[u].add(source)
+        self.successors[u].discard(v)
+        self.predecessors[u].discard(v)
+        self.successors[v] = set()
+        self.predecessors[v] = set()
+        return True
+
 def compute_node_equivalence(g1, g2):
-    helper_graph = nx.union(g1, g2, rename=('g1-','g2-')) #nodes start with `rename` prefix. Used to check for cycles
     equivalence_g1 = {} # maps nodes from g1 to g2
     equivalence_g2 = {} # maps nodes from g2 to g1
     len_g1 = len(g1.nodes)
     len_g2 = len(g2.nodes)
     similarity_matrix = compute_node_similarity_matrix(g1, g2)
-    try:
-        similarity_matrix = similarity_flooding(similarity_matrix, g1, g2, alpha = 0.1, n_iter = 50)
-    except Exception:
-        print("Similarity flooding failed. PCG graph has no nodes or edges.")
+    if SIMILARITY_FLOODING:
+        try:
+            similarity_matrix = similarity_flooding(similarity_matrix, g1, g2, alpha = FLOODING_ALPHA, n_iter = FLOODING_N_ITER, tol = FLOODING_TOL)
+        except Exception:
+            print("Similarity flooding failed. PCG graph has no nodes or edges.")
     edit_cost_matrix = compute_edit_cost_matrix(similarity_matrix, 0.4, 0.4)
     rows, cols = linear_sum_assignment(edit_cost_matrix)
     nodes_g1 = list(g1.nodes)
     nodes_g2 = list(g2.nodes)
+
+    # Union of g1 and g2 (g2 nodes are offset by len_g1). Used to check for cycles
+    index_g1 = {node: idx for idx, node in enumerate(nodes_g1)}
+    index_g2 = {node: len_g1 + idx for idx, node in enumerate(nodes_g2)}
+    helper_graph = ContractionGraph(
+        len_g1 + len_g2,
+        [(index_g1[s], index_g1[d]) for s, d in g1.edges] + [(index_g2[s], index_g2[d]) for s, d in g2.edges]
+    )
     for pairs in zip(rows, cols):
         if pairs[0] < len_g1 and pairs[1] < len_g2:
             # nodes are equivalent
             eq_g1 = nodes_g1[pairs[0]]
             eq_g2 = nodes_g2[pairs[1]]
-            merged_helper = nx.algorithms.minors.contracted_nodes(helper_graph, 'g1-'+eq_g1, 'g2-'+eq_g2, self_loops=False)
-            try:
-                if 'g1-inputs.0' in merged_helper:
-                    cycles = nx.algorithms.cycles.find_cycle(merged_helper, source = 'g1-inputs.0')
-                if 'g2-inputs.0' in merged_helper:
-                    cycles = nx.algorithms.cycles.find_cycle(merged_helper, source = 'g2-inputs.0')
-            except nx.NetworkXNoCycle as n:
+            if helper_graph.contract(pairs[0], len_g1 + pairs[1]):
                 equivalence_g2[eq_g2] = eq_g1
                 equivalence_g1[eq_g1] = eq_g2
-                helper_graph = merged_helper
     return equivalence_g1, equivalence_g2
 
 def dict_append(dictionary, key, value):
@@ -144,52 +270,95 @@ def dict_append(dictionary, key, value):
     else:
         dictionary[key] = [value]
 
+def unique_node_name(prefix, node, used_names):
+    # Unmatched nodes are prefixed with the graph they come from. The prefix is repeated if the name is taken (e.g.
+    # by a matched node named "G2.steps.0" in a previously merged graph), otherwise distinct nodes would be merged.
+    name = prefix + node
+    while name in used_names:
+        name = prefix + name
+    used_names.add(name)
+    return name
+
 def merge_graphs(g1, g2):
     equivalence_g1, equivalence_g2 = compute_node_equivalence(g1, g2)
+    used_names = set(equivalence_g1)
+    names_g1 = {node: node if node in equivalence_g1 else unique_node_name("G1.", node, used_names) for node in g1.nodes}
+    names_g2 = {node: equivalence_g2[node] if node in equivalence_g2 else unique_node_name("G2.", node, used_names) for node in g2.nodes}
     G = nx.DiGraph()
     # Adding g1 node data
     for node in g1.nodes:
-        data = g1.nodes[node]["data"]
-        if node not in equivalence_g1:
-            node = "G1." + node
-        G.add_node(node)
-        G.nodes[node]["data"] = data
+        G.add_node(names_g1[node], data = g1.nodes[node]["data"])
 
     # Adding g2 node data
     for node in g2.nodes:
         data = g2.nodes[node]["data"]
         if node not in equivalence_g2:
-            node = "G2." + node
-            G.add_node(node, data = data)
+            G.add_node(names_g2[node], data = data)
         else:
-            node = equivalence_g2[node]
+            node = names_g2[node]
             G.nodes[node]["data"] = G.nodes[node]["data"] + data
 
     # Adding edges from g1
-    for edge in g1.edges:
-        source, dest = edge
-        if source not in equivalence_g1:
-            source = "G1." + source
-        if dest not in equivalence_g1:
-            dest = "G1." + dest
-        G.add_edge(source, dest)
+    for source, dest in g1.edges:
+        G.add_edge(names_g1[source], names_g1[dest])
 
     # Merging edges from g2
-    for edge in g2.edges:
-        source, dest = edge
-        if source not in equivalence_g2:
-            source = "G2." + source
-        else:
-            source = equivalence_g2[source]
-        if dest not in equivalence_g2:
-            dest = "G2." + dest
-        else:
-            dest = equivalence_g2[dest]
-        G.add_edge(source, dest)
+    for source, dest in g2.edges:
+        G.add_edge(names_g2[source], names_g2[dest])
     return G
 
-def merge_multiple_graphs(graphs):
-    merged = merge_graphs(graphs[0], graphs[1])
-    for graph in graphs[2:]:
-        merged = merge_graphs(merged, graph)
-    return merged
\ No newline at end of file
+def pair_graphs_by_similarity(graphs):
+    # Greedily pairs the graphs with the most similar sets of primitives (Jaccard index), most similar pairs first.
+    # Returns the list of pairs of indices and the indices left unpaired.
+    path_codes = {}
+    rows, cols = [], []
+    for idx, g in enumerate(graphs):
+        paths = {data['python_path'] for node in g.nodes for data in g.nodes[node]['data']}
+        rows.extend([idx] * len(paths))
+        cols.extend(path_codes.setdefault(path, len(path_codes)) for path in paths)
+    incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(graphs), len(path_codes)))
+    intersection = (incidence @ incidence.T).toarray()
+    sizes = np.diag(intersection)
+    similarity = intersection / np.maximum(sizes[:, None] + sizes[None, :] - intersection, 1)
+    first, second = np.triu_indices(len(graphs), 1)
+    order = np.argsort(-similarity[first, second], kind='stable')
+    paired = np.zeros(len(graphs), dtype=bool)
+    pairs = []
+    for i, j in zip(first[order], second[order]):
+        if not paired[i] and not paired[j]:
+            paired[i] = paired[j] = True
+            pairs.append((i, j))
+    return pairs, list(np.flatnonzero(~paired))
+
+def merge_multiple_graphs(graphs, tree=False, pair_by_similarity=False, n_jobs=None):
+    # By default, graphs are merged one by one into the merged graph (fold left).
+    # With tree=True, graphs are merged in independent pairs and the results are merged level by level, so each
+    # level can run in a process pool of n_jobs workers (see _parallel.py). Pairs are consecutive graphs, or the
+    # graphs with the most similar primitives if pair_by_similarity=True.
+    if not tree:
+        merged = merge_graphs(graphs[0], graphs[1])
+        for graph in graphs[2:]:
+            merged = merge_graphs(merged, graph)
+        return merged
+
+    n_workers = resolve_n_jobs(n_jobs, len(graphs) // 2)
+    executor = make_executor(n_workers) if n_workers is not None else None
+    try:
+        level = list(graphs)
+        while len(level) > 1:
+            if pair_by_similarity:
+                pairs, unpaired = pair_graphs_by_similarity(level)
+            else:
+                pairs = [(idx, idx + 1) for idx in range(0, len(level) - 1, 2)]
+                unpaired = [len(level) - 1] if len(level) % 2 else []
+            firsts = [level[i] for i, _ in pairs]
+            seconds = [level[j] for _, j in pairs]
+            if executor is not None and len(pairs) > 1:
+                merged = list(executor.map(merge_graphs, firsts, seconds))
+            else:
+                merged = list(map(merge_graphs, firsts, seconds))
+            level = merged + [level[idx] for idx in unpaired]
+        return level[0]
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+import json
+import math
+from ._plot_registry import get_plot
+
+#####
+# Hyperparameters of the pipeline matrix, served through the hyperparams_comm_api
+#
+# Plots created by plot_pipeline_matrix(..., hyperparams_on_demand=True) do not send hyperparameters to the browser.
+# The frontend requests the hyperparameter table of an expanded primitive (same output as
+# computePrimitiveHyperparameterData in js/helpers.js), or the hyperparameters of the steps of a pipeline (for tooltips
+# and the pipeline graph) when needed.
+# The index is kept with the pipelines of the plot in _plot_registry.
+
+# Same as constants.skipHyperparameters in js/helpers.js
+SKIP_HYPERPARAMETERS = {'use_inputs_columns', 'use_outputs_columns', 'exclude_inputs_columns', 'exclude_outputs_columns',
+                        'return_result', 'return_semantic_type', 'use_semantic_types', 'add_index_columns', 'use_columns',
+                        'exclude_columns', 'error_on_no_input', 'n_jobs', 'class_weight'}
+
+
+
+def build_hyperparameter_index(pipelines):
+    # Returns {python_path: {pipeline_digest: [hyperparams of each step using python_path]}}
+    by_primitive = {}
+    for pipeline in pipelines:
+        digest = pipeline['pipeline_digest']
+        for step in pipeline['steps']:
+            if 'hyperparams' in step:
+                primitive_steps = by_primitive.setdefault(step['primitive']['python_path'], OrderedDict())
+                primitive_steps.setdefault(digest, []).append(step['hyperparams'])
+    return by_primitive
+
+
+def register_hyperparameter_index(plot_id):
+    plot = get_plot(plot_id)
+    plot['hyperparameter_index'] = build_hyperparameter_index(plot['pipelines'])
+
+
+def to_fixed(value):
+    # Number.prototype.toFixed(5): closest multiple of 1e-5, ties away from zero
+    return str(Decimal(value).quantize(Decimal('0.00001'), rounding=ROUND_HALF_UP))
+
+
+def replace_floats(data):
+    # Same as JSONStringReplacer in js/helpers.js: non integer numbers are written with 5 decimals
+    if isinstance(data, float):
+        if math.isnan(data):
+            return 'NaN'
+        if math.isinf(data):
+            return 'Infinity' if data > 0 else '-Infinity'
+        return int(data) if data.is_integer() else to_fixed(data)
+    if isinstance(data, dict):
+        return {key: replace_floats(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [replace_floats(value) for value in data]
+    return data
+
+
+def format_hyperparam_value(hyperparam):
+    # Same as accessHyperparamValue in js/helpers.js
+    data = hyperparam.get('data')
+    while isinstance(data, dict) and 'value' in data:
+        data = data['value']
+    value = json.dumps(replace_floats(data), ensure_ascii=False, separators=(',', ':'))
+    return value.replace('"', '').replace("https://metadata.datadrivendiscovery.org/types/", "")
+
+
+def compute_primitive_hyperparameter_data(plot_id, python_path, pipeline_digests):
+    # Same as computePrimitiveHyperparameterData in js/helpers.js, for the pipelines with the given digests (in order)
+    primitive_steps = get_plot(plot_id)['hyperparameter_index'].get(python_path, {})
+    step_samples = []
+    unique_checker = set()
+    header = set()
+    for digest in pipeline_digests:
+        for hyperparams in primitive_steps.get(digest, []):
+            for key, hyperparam in hyperparams.items():
+                if key in SKIP_HYPERPARAMETERS:
+                    continue
+                value = format_hyperparam_value(hyperparam)
+                unique_key = digest + key + value
+                header_key = '{}: {}'.format(key, value)
+                header.add(header_key)
+                if unique_key not in unique_checker:
+                    step_samples.append({
+                        'pipeline_digest': digest,
+                        'hyperparam': key,
+                        'value': value,
+                        'unique_key': unique_key,
+                        'header_key': header_key,
+                    })
+                    unique_checker.add(unique_key)
+    return {'orderedHeader': sorted(header), 'stepSamples': step_samples}
+
+
+def get_pipeline_hyperparams(plot_id, pipeline_digest):
+    # Hyperparameters of each step of the pipeline, or None
+    pipeline = get_plot(plot_id)['by_digest'][pipeline_digest]
+    return [step.get('hyperparams') for step in pipeline['steps']]
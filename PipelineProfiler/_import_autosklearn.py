@@ -1,4 +1,21 @@
+from itertools import repeat
 import numpy as np
+from ._parallel import resolve_n_jobs, make_executor
+
+#####
+# Import of auto-sklearn runs
+#
+# The configurations (cv_results_['params'] and the ensemble members) are converted to pipelines with one step per
+# component. The step structure only depends on the keys of a configuration (and on whether class balancing is used),
+# so it is computed once for each group of configurations with the same structure, and the parameter keys are parsed
+# once for all configurations.
+#
+# Usage:
+#
+# pipelines = import_autosklearn(automl)
+# pipelines = import_autosklearn_test_data(automl, test_X, test_y, sklearn.metrics.accuracy_score, n_jobs=-1)
+
+NODE_ORDER = ['balancing', 'data_preprocessing', 'feature_preprocessor', 'classifier', 'regressor']
 
 class DefaultOrder:
     def __init__(self, order):
@@ -20,187 +37,193 @@ def find_metric_name(automl):
     except Exception as e:
         return "METRIC"
 
+def canonical_config(config):
+    # Hashable configuration, equal for equal configurations. None if a value is not hashable
+    try:
+        key = frozenset(config.items())
+        hash(key)
+        return key
+    except TypeError:
+        return None
+
+def get_ensemble_members(models_with_weights):
+    # Returns [(weight, configuration)] of the ensemble members, up to the first member whose configuration cannot be
+    # read, and whether such a member was found
+    members = []
+    for weight, pipeline in models_with_weights:
+        try:
+            members.append((weight, pipeline.config.get_dictionary()))
+        except Exception:
+            return members, True
+    return members, False
+
 def find_ensemble_weights(all_params, models_with_weights):
+    # Weight of the first ensemble member with the same configuration as each of all_params. If the configuration of a
+    # member cannot be read, the weights found before reaching it are kept (the search stops at the first configuration
+    # that does not match an earlier member)
     weights = np.zeros(len(all_params))
-    try:
-      for idx, param in enumerate(all_params):
-          for weight, pipeline in models_with_weights:
-              weighted_param = pipeline.config.get_dictionary()
-              if param == weighted_param:
-                  weights[idx] = weight
-                  break
-    except Exception:
-        pass
+    members, failed = get_ensemble_members(models_with_weights)
+    member_weights = {}
+    unhashable_members = []
+    for weight, config in members:
+        key = canonical_config(config)
+        if key is None:
+            unhashable_members.append((weight, config))
+        else:
+            member_weights.setdefault(key, weight)
+    for idx, param in enumerate(all_params):
+        key = canonical_config(param)
+        if key is None or unhashable_members:
+            weight = next((weight for weight, config in members if param == config), None)
+        else:
+            weight = member_weights.get(key)
+        if weight is None:
+            if failed:
+                break
+            continue
+        weights[idx] = weight
     return weights
 
-def import_autosklearn(automl, source='auto-sklearn'):
-    cv_results = automl.cv_results_
-    weights = find_ensemble_weights(automl.cv_results_['params'], automl.get_models_with_weights())
-    node_order = DefaultOrder(['balancing', 'data_preprocessing', 'feature_preprocessor','classifier', 'regressor'])
-    n_models = len(cv_results['mean_test_score'])
-    pipelines = []
-    metric_name = find_metric_name(automl)
-    for i in range(n_models):
-        # Computing auxiliary pipeline structure
-        struct = {}
-        for key in cv_results['params'][i]:
-            split = key.split(":")
-            if split[0] == 'balancing' and split[1] == 'strategy':
-                if cv_results['params'][i][key] != 'none':
-                    struct['balancing'] = {'class_balancing': {'strategy': cv_results['params'][i][key]}}
-                continue
-            if split[1] == '__choice__':
-                continue
-            module_type = split[0]
-            if module_type not in struct:
-                struct[module_type] = {}    
-            module_name = split[1]
-            if module_name not in struct[module_type]:
-                struct[module_type][module_name] = {}
-            module_param = '_'.join(filter(lambda x: x != '__choice__', split[2:]))
-            struct[module_type][module_name][module_param] = cv_results['params'][i][key]
-        ordered_types = struct.keys()
-        ordered_types = sorted(ordered_types, key=lambda x: node_order(x))
-
-        # Creating pipeline graph
+def parse_param_key(key):
+    # Splits a configuration key ("<module type>:<module name>:<param>...") into
+    # ('balancing', None, None, None), ('choice', None, None, None) or ('param', module type, module name, param)
+    split = key.split(":")
+    if split[0] == 'balancing' and split[1] == 'strategy':
+        return ('balancing', None, None, None)
+    if split[1] == '__choice__':
+        return ('choice', None, None, None)
+    return ('param', split[0], split[1], '_'.join(filter(lambda x: x != '__choice__', split[2:])))
+
+def make_pipeline_structure(keys, balancing, node_order):
+    # Steps of the pipelines of the configurations with the given keys, as
+    # [(module type, module name, step reference, [input references], [(hyperparam, configuration key)])], and the
+    # output references. balancing: configuration keys of the class balancing strategy whose value is not 'none'
+    struct = {}
+    for key, (kind, module_type, module_name, module_param) in keys:
+        if kind == 'balancing':
+            if key in balancing:
+                struct['balancing'] = {'class_balancing': {'strategy': key}}
+            continue
+        if kind == 'choice':
+            continue
+        struct.setdefault(module_type, {}).setdefault(module_name, {})[module_param] = key
+    ordered_types = sorted(struct.keys(), key=lambda x: node_order(x))
+
+    steps = []
+    prev_list = ['inputs.0']
+    for module_type in ordered_types:
+        new_prev_list = []
+        for module_name, params in struct[module_type].items():
+            step_ref = 'steps.{}.produce'.format(len(steps))
+            new_prev_list.append(step_ref)
+            steps.append((module_type, module_name, step_ref, prev_list, list(params.items())))
+        prev_list = new_prev_list
+    return steps, prev_list
+
+def make_pipeline_builder():
+    # Returns a function creating the pipeline of a configuration (dict of auto-sklearn parameters)
+    node_order = DefaultOrder(NODE_ORDER)
+    parsed_keys = {} # configuration key -> parse_param_key(key)
+    structures = {} # (configuration keys, balancing keys) -> make_pipeline_structure(...)
+
+    def build_pipeline(config, scores, source, digest):
+        keys = tuple(config)
+        for key in keys:
+            if key not in parsed_keys:
+                parsed_keys[key] = parse_param_key(key)
+        balancing = tuple(key for key in keys if parsed_keys[key][0] == 'balancing' and config[key] != 'none')
+        structure = structures.get((keys, balancing))
+        if structure is None:
+            structure = structures[(keys, balancing)] = make_pipeline_structure(
+                [(key, parsed_keys[key]) for key in keys], balancing, node_order)
+        steps, outputs = structure
+
         pipeline = {
             'inputs': [{'name': 'input dataset'}],
             'steps': [],
-            'scores': [{
-                'metric': {'metric': metric_name, 'params': {'pos_label': '1'}},
-                'normalized': cv_results['mean_test_score'][i],
-                'value': cv_results['mean_test_score'][i],
-            },
-            {
-                'metric': {'metric': 'ENSEMBLE WEIGHT', 'params': {'pos_label': '2'}},
-                'normalized': weights[i],
-                'value': weights[i]
-            },{
-                'metric': {'metric': 'MEAN FIT TIME', 'params': {'pos_label': '3'}},
-                'normalized': cv_results['mean_fit_time'][i],
-                'value': cv_results['mean_fit_time'][i],
-            }],
+            'scores': scores,
             'pipeline_source': {'name': source},
-            'pipeline_digest': '{}'.format(i),
+            'pipeline_digest': digest,
         }
-        prev_list = ['inputs.0']
-        cur_step_idx = 0
-        for module_type in ordered_types:
-            new_prev_list = []
-            modules = struct[module_type]
-            for module in modules:
-                step_ref = 'steps.{}.produce'.format(cur_step_idx)
-                cur_step_idx += 1
-                new_prev_list.append(step_ref)
-                step = {
-                    'primitive': {'python_path':'auto_sklearn.primitives.{}.{}'.format(module_type, module), 'name': module},
-                    'arguments':{},
-                    'outputs': [{'id': 'produce'}],
-                    'reference': {'type': 'CONTAINER', 'data': step_ref},
-                    'hyperparams': {}
-                }
-                for param in struct[module_type][module]:
-                    step['hyperparams'][param] = {
-                        'type': 'VALUE',
-                        'data': struct[module_type][module][param]
-                    }                
-                for idx, prev in enumerate(prev_list):
-                    cur_argument_idx = 'input{}'.format(idx)
-                    step['arguments'][cur_argument_idx] = {
-                        'data': prev
-                    }
-                pipeline['steps'].append(step)
-            prev_list = new_prev_list
-        pipeline['outputs'] = []
-        for prev in prev_list:
-            pipeline['outputs'].append({'data': prev})        
-        pipelines.append(pipeline)
-    return pipelines
+        for module_type, module_name, step_ref, prev_list, params in steps:
+            pipeline['steps'].append({
+                'primitive': {'python_path': 'auto_sklearn.primitives.{}.{}'.format(module_type, module_name), 'name': module_name},
+                'arguments': {'input{}'.format(idx): {'data': prev} for idx, prev in enumerate(prev_list)},
+                'outputs': [{'id': 'produce'}],
+                'reference': {'type': 'CONTAINER', 'data': step_ref},
+                'hyperparams': {param: {'type': 'VALUE', 'data': config[key]} for param, key in params},
+            })
+        pipeline['outputs'] = [{'data': prev} for prev in outputs]
+        return pipeline
 
-def import_autosklearn_test_data(automl, test_X, test_y, metric_eval, source='auto-sklearn'):
-    node_order = DefaultOrder(['balancing', 'data_preprocessing', 'feature_preprocessor','classifier', 'regressor'])
+    return build_pipeline
+
+def make_cv_scores(cv_results, i, weights, metric_name):
+    return [{
+        'metric': {'metric': metric_name, 'params': {'pos_label': '1'}},
+        'normalized': cv_results['mean_test_score'][i],
+        'value': cv_results['mean_test_score'][i],
+    },
+    {
+        'metric': {'metric': 'ENSEMBLE WEIGHT', 'params': {'pos_label': '2'}},
+        'normalized': weights[i],
+        'value': weights[i]
+    },{
+        'metric': {'metric': 'MEAN FIT TIME', 'params': {'pos_label': '3'}},
+        'normalized': cv_results['mean_fit_time'][i],
+        'value': cv_results['mean_fit_time'][i],
+    }]
+
+def import_autosklearn(automl, source='auto-sklearn'):
+    cv_results = automl.cv_results_
+    weights = find_ensemble_weights(cv_results['params'], automl.get_models_with_weights())
+    n_models = len(cv_results['mean_test_score'])
+    metric_name = find_metric_name(automl)
+    build_pipeline = make_pipeline_builder()
+    return [build_pipeline(cv_results['params'][i], make_cv_scores(cv_results, i, weights, metric_name), source, '{}'.format(i))
+            for i in range(n_models)]
+
+def predict_in_chunks(model, test_X, chunk_size=None):
+    # Predictions of model for test_X, computed on chunks of chunk_size rows to bound the memory used by predict
+    n_rows = test_X.shape[0] if hasattr(test_X, 'shape') else len(test_X)
+    if chunk_size is None or n_rows <= chunk_size:
+        return model.predict(test_X)
+    slice_rows = (lambda start: test_X.iloc[start:start + chunk_size]) if hasattr(test_X, 'iloc') else (lambda start: test_X[start:start + chunk_size])
+    return np.concatenate([model.predict(slice_rows(start)) for start in range(0, n_rows, chunk_size)])
+
+def score_model(model, test_X, test_y, metric_eval, chunk_size=None):
+    return metric_eval(test_y, predict_in_chunks(model, test_X, chunk_size))
+
+def score_models(models, test_X, test_y, metric_eval, n_jobs=None, backend='threads', chunk_size=None):
+    # Returns the scores of the models, in order. The models are scored concurrently by n_jobs workers (see
+    # _parallel.py), in a thread pool, or in a process pool if backend='processes' (models, test data and metric_eval
+    # are pickled for every model)
+    if backend not in ('threads', 'processes'):
+        raise ValueError("Unknown backend {}, use 'threads' or 'processes'".format(backend))
+    n_workers = resolve_n_jobs(n_jobs, len(models))
+    if n_workers is None:
+        return [score_model(model, test_X, test_y, metric_eval, chunk_size) for model in models]
+    with make_executor(n_workers, backend) as executor:
+        return list(executor.map(score_model, models, repeat(test_X), repeat(test_y), repeat(metric_eval), repeat(chunk_size)))
+
+def import_autosklearn_test_data(automl, test_X, test_y, metric_eval, source='auto-sklearn', n_jobs=None, backend='threads', chunk_size=None):
+    # n_jobs: number of models scored concurrently (-1 for all CPUs), see score_models
+    # chunk_size: if set, models predict at most chunk_size rows of test_X at a time
     models_with_weights = automl.get_models_with_weights()
-    weights = []
-    models = []
-    for weight, model in models_with_weights:
-        weights.append(weight)
-        models.append(model)
-    n_models = len(models)
+    scores = score_models([model for _, model in models_with_weights], test_X, test_y, metric_eval, n_jobs=n_jobs,
+                          backend=backend, chunk_size=chunk_size)
+    build_pipeline = make_pipeline_builder()
     pipelines = []
-    for i in range(n_models):
-        # Computing auxiliary pipeline structure
-        config = models[i].config.get_dictionary()
-        struct = {}
-        for key in config:
-            split = key.split(":")
-            if split[0] == 'balancing' and split[1] == 'strategy':
-                if config[key] != 'none':
-                    struct['balancing'] = {'class_balancing': {'strategy': config[key]}}
-                continue
-            if split[1] == '__choice__':
-                continue
-            module_type = split[0]
-            if module_type not in struct:
-                struct[module_type] = {}
-            module_name = split[1]
-            if module_name not in struct[module_type]:
-                struct[module_type][module_name] = {}
-            module_param = '_'.join(filter(lambda x: x != '__choice__', split[2:]))
-            struct[module_type][module_name][module_param] = config[key]
-        ordered_types = struct.keys()
-        ordered_types = sorted(ordered_types, key=lambda x: node_order(x))
-
-        # Computing score
-        pred_y = models[i].predict(test_X)
-        score = metric_eval(test_y, pred_y)
-
-        # Creating pipeline graph
-        pipeline = {
-            'inputs': [{'name': 'input dataset'}],
-            'steps': [],
-            'scores': [{
-                'metric': {'metric': str(metric_eval).capitalize(), 'params': {'pos_label': '1'}},
-                'normalized': score,
-                'value': score,
-            },
-            {
-                'metric': {'metric': 'Ensemble Weight', 'params': {'pos_label': '2'}},
-                'normalized': weights[i],
-                'value': weights[i]
-            }],
-            'pipeline_source': {'name': source},
-            'pipeline_digest': '{}'.format(i),
-        }
-        prev_list = ['inputs.0']
-        cur_step_idx = 0
-        for module_type in ordered_types:
-            new_prev_list = []
-            modules = struct[module_type]
-            for module in modules:
-                step_ref = 'steps.{}.produce'.format(cur_step_idx)
-                cur_step_idx += 1
-                new_prev_list.append(step_ref)
-                step = {
-                    'primitive': {'python_path':'auto_sklearn.primitives.{}.{}'.format(module_type, module), 'name': module},
-                    'arguments':{},
-                    'outputs': [{'id': 'produce'}],
-                    'reference': {'type': 'CONTAINER', 'data': step_ref},
-                    'hyperparams': {}
-                }
-                for param in struct[module_type][module]:
-                    step['hyperparams'][param] = {
-                        'type': 'VALUE',
-                        'data': struct[module_type][module][param]
-                    }
-                for idx, prev in enumerate(prev_list):
-                    cur_argument_idx = 'input{}'.format(idx)
-                    step['arguments'][cur_argument_idx] = {
-                        'data': prev
-                    }
-                pipeline['steps'].append(step)
-            prev_list = new_prev_list
-        pipeline['outputs'] = []
-        for prev in prev_list:
-            pipeline['outputs'].append({'data': prev})
-        pipelines.append(pipeline)
-    return pipelines
\ No newline at end of file
+    for i, ((weight, model), score) in enumerate(zip(models_with_weights, scores)):
+        pipeline_scores = [{
+            'metric': {'metric': str(metric_eval).capitalize(), 'params': {'pos_label': '1'}},
+            'normalized': score,
+            'value': score,
+        },
+        {
+            'metric': {'metric': 'Ensemble Weight', 'params': {'pos_label': '2'}},
+            'normalized': weight,
+            'value': weight
+        }]
+        pipelines.append(build_pipeline(model.config.get_dictionary(), pipeline_scores, source, '{}'.format(i)))
+    return pipelines
@@ -0,0 +1,68 @@
+import sys
+import pkg_resources
+from functools import lru_cache
+
+#####
+# Embeds the javascript bundle (build/pipelineVis.js) in the plots' HTML
+#
+# By default every plot inlines the bundle, so each output renders on its own (saved notebooks, cleared outputs,
+# kernel restarts). With set_inline_bundle_once(True), in Jupyter the bundle is inlined in the next plot only, and the
+# following plots only contain a small script that waits for `pipelineVis` to be defined. Standalone HTML
+# (get_pipeline_profiler_html) and Colab, where each output runs in its own frame, always inline the bundle.
+# If the output with the bundle is cleared, or the notebook is reopened, call reset_js_bundle() and plot again.
+#
+# Usage:
+#
+# PipelineProfiler.set_inline_bundle_once(True)
+
+INLINE_BUNDLE_ONCE = False
+
+_bundle_loaded = False
+
+
+@lru_cache(maxsize=None)
+def load_bundle():
+    lib_path = pkg_resources.resource_filename(__name__, "build/pipelineVis.js")
+    with open(lib_path, "r", encoding="utf8") as f:
+        return f.read()
+
+
+def set_inline_bundle_once(enabled):
+    # enabled: inline the bundle in the next plot only, instead of in every plot
+    global INLINE_BUNDLE_ONCE
+    INLINE_BUNDLE_ONCE = enabled
+    reset_js_bundle()
+
+
+def reset_js_bundle():
+    # Inlines the bundle again in the next plot
+    global _bundle_loaded
+    _bundle_loaded = False
+
+
+def make_bundle_script(standalone=False):
+    global _bundle_loaded
+    if standalone or not INLINE_BUNDLE_ONCE or 'google.colab' in sys.modules:
+        return "<script>{}</script>".format(load_bundle())
+    if _bundle_loaded:
+        return ""
+    _bundle_loaded = True
+    return "<script>{}</script>".format(load_bundle())
+
+
+def make_render_script(id, draw_call):
+    # Calls `pipelineVis.<draw_call>` once the bundle is loaded (it may be loaded by the output of another cell)
+    return """
+    <script>
+    (function render(attempt) {{
+        if (typeof pipelineVis !== "undefined") {{
+            pipelineVis.{draw_call};
+        }} else if (attempt < 50) {{
+            setTimeout(function() {{ render(attempt + 1); }}, 100);
+        }} else {{
+            document.getElementById("{id}").innerText = "PipelineProfiler javascript is not loaded. " +
+                "Run PipelineProfiler.reset_js_bundle() and plot again.";
+        }}
+    }})(0);
+    </script>
+    """.format(id=id, draw_call=draw_call)
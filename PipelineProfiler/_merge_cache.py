@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import hashlib
+import json
+import pickle
+import threading
+from ._graph_matching import pipeline_to_graph, merge_graphs, merge_multiple_graphs
+
+#####
+# Caches pipeline graphs and merged graphs between selections of the pipeline matrix
+#
+# Usage:
+#
+# from PipelineProfiler._merge_cache import merge_pipelines, get_merge_cache_info
+# merged = merge_pipelines(pipelines[:10])
+# merged = merge_pipelines(pipelines[:11]) # only merges pipelines[10] into the cached result
+# get_merge_cache_info() # {'graphs': {'hits': ..., 'misses': ..., ...}, 'merges': {...}}
+
+GRAPH_CACHE_ITEMS = 4096
+GRAPH_CACHE_BYTES = 2**26
+MERGE_CACHE_ITEMS = 64
+MERGE_CACHE_BYTES = 2**28
+
+
+def pickled_size(value):
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class LRUCache:
+    # Least recently used cache bounded by number of items and by total size in bytes (as measured by `sizeof`).
+    # Thread safe, merge_pipelines runs on the comm worker threads.
+
+    def __init__(self, max_items, max_bytes, sizeof=pickled_size):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = OrderedDict() # key -> (value, size)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self.get_first([key], (None, default))[1]
+
+    def get_first(self, keys, default=(None, None)):
+        # Returns (key, value) for the first of the keys (any iterable) in the cache, or default. Counts a single hit or
+        # miss.
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self.hits += 1
+                    self.items.move_to_end(key)
+                    return key, self.items[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.n_bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.n_bytes += size
+            while len(self.items) > self.max_items or self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.n_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.n_bytes = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'items': len(self.items), 'bytes': self.n_bytes,
+                    'max_items': self.max_items, 'max_bytes': self.max_bytes}
+
+
+graph_cache = LRUCache(GRAPH_CACHE_ITEMS, GRAPH_CACHE_BYTES) # pipeline_cache_key -> pipeline graph
+merge_cache = LRUCache(MERGE_CACHE_ITEMS, MERGE_CACHE_BYTES) # (tree, tuple of pipeline_cache_key) -> merged graph
+
+
+def pipeline_cache_key(pipeline):
+    # Digests are not unique across plots (e.g. import_autosklearn numbers the pipelines from 0), so pipelines are
+    # identified by their digest and a hash of the fields their graph is built from
+    content = json.dumps([pipeline['steps'], pipeline['outputs']], sort_keys=True, default=str)
+    return pipeline['pipeline_digest'], hashlib.sha1(content.encode('utf8')).hexdigest()
+
+
+def get_pipeline_graph(pipeline, key=None):
+    if key is None:
+        key = pipeline_cache_key(pipeline)
+    graph = graph_cache.get(key)
+    if graph is None:
+        graph = pipeline_to_graph(pipeline, pipeline['pipeline_digest'])
+        graph_cache.put(key, graph)
+    return graph
+
+
+def merge_pipelines(pipelines, tree=False, n_jobs=None):
+    # Merges the graphs of the pipelines. The result only depends on the pipelines (and on tree), not on the cache:
+    # By default, the graphs are merged one by one (fold left, as merge_multiple_graphs). If the merge of a prefix of
+    #   the pipelines is cached, the remaining pipelines are merged into it.
+    # tree=True: tree reduction with pairs of similar graphs (see merge_multiple_graphs). Only complete merges are
+    #   reused. n_jobs: the levels of the tree run in a process pool if n_jobs > 1 (n_jobs < 0 for all CPUs). Serial by
+    #   default: for interactive selections, starting a pool (and pickling the graphs) is slower than merging, and
+    #   forking the kernel from a comm worker thread can deadlock.
+    keys = tuple(pipeline_cache_key(pipeline) for pipeline in pipelines)
+    if tree:
+        merged = merge_cache.get((tree, keys))
+        if merged is not None:
+            return merged
+        graphs = [get_pipeline_graph(pipeline, key) for pipeline, key in zip(pipelines, keys)]
+        merged = merge_multiple_graphs(graphs, tree=True, pair_by_similarity=True, n_jobs=n_jobs) if len(graphs) > 1 else graphs[0]
+    else:
+        # longest cached prefix, including the complete selection
+        prefix, merged = merge_cache.get_first((False, keys[:k]) for k in range(len(keys), 0, -1))
+        if prefix is not None and len(prefix[1]) == len(keys):
+            return merged
+        if prefix is not None:
+            prefix_length = len(prefix[1])
+        else:
+            merged = get_pipeline_graph(pipelines[0], keys[0])
+            prefix_length = 1
+        for pipeline, key in zip(pipelines[prefix_length:], keys[prefix_length:]):
+            merged = merge_graphs(merged, get_pipeline_graph(pipeline, key))
+    merge_cache.put((tree, keys), merged)
+    return merged
+
+
+def get_merge_cache_info():
+    return {'graphs': graph_cache.info(), 'merges': merge_cache.info()}
+
+
+def clear_merge_cache():
+    graph_cache.clear()
+    merge_cache.clear()
@@ -0,0 +1,38 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+#####
+# Worker pools of the functions with an n_jobs parameter
+#
+# n_jobs has the same meaning everywhere:
+#   None, 0 or 1: run serially, in the calling thread
+#   n > 1: use n workers
+#   n < 0: use one worker per CPU (os.cpu_count())
+# Functions run serially when there are less than two tasks, starting a pool would only add overhead.
+#
+# Usage:
+#
+# n_workers = resolve_n_jobs(n_jobs, len(tasks))
+# if n_workers is None:
+#     results = [function(task) for task in tasks]
+# else:
+#     with make_executor(n_workers) as executor:
+#         results = list(executor.map(function, tasks))
+
+BACKENDS = {'processes': ProcessPoolExecutor, 'threads': ThreadPoolExecutor}
+
+
+def resolve_n_jobs(n_jobs, n_tasks=None):
+    # Returns the number of workers for n_jobs, or None to run serially
+    if n_jobs is None:
+        return None
+    n_workers = (os.cpu_count() or 1) if n_jobs < 0 else n_jobs
+    if n_workers <= 1 or (n_tasks is not None and n_tasks <= 1):
+        return None
+    return n_workers
+
+
+def make_executor(n_workers, backend='processes'):
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}, use 'threads' or 'processes'".format(backend))
+    return BACKENDS[backend](max_workers=n_workers)
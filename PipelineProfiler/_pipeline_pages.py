@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import numbers
+import numpy as np
+from ._plot_registry import get_plot
+
+#####
+# Paged rows of the pipeline matrix
+#
+# In paged mode (plot_pipeline_matrix(pipelines, page_size=...)), the plot only receives the first rows, and fetches
+# the next ones (or the first rows in another order) through the pipeline_pages_comm_api.
+# The row orders of every (sort, metric) are computed when the plot is created, and kept with the pipelines of the plot
+# in _plot_registry, so fetching a page only copies the rows of the page.
+
+# Same values as constants.sortPipelineBy in js/helpers.js
+SORT_BY_SCORE = 'PIPELINE_SCORE'
+SORT_BY_SOURCE = 'PIPELINE_SOURCE'
+
+
+def extract_metric_names(pipelines):
+    # Same order as extractMetricNames in js/helpers.js
+    metrics = OrderedDict()
+    for pipeline in pipelines:
+        for name in pipeline['score_map']:
+            metrics[name] = True
+    return list(metrics)
+
+
+def extract_metric_scores(pipelines, metrics, score_type='normalized'):
+    # Same as extractMetric in js/helpers.js, as a pipelines x metrics matrix: 0 if the pipeline does not have the
+    # metric, NaN if its score has no numeric `score_type` value (undefined or null in javascript)
+    def extract(pipeline, metric):
+        if metric not in pipeline['score_map']:
+            return 0
+        value = pipeline['score_map'][metric].get(score_type)
+        return value if isinstance(value, numbers.Real) else np.nan
+    return np.array([[extract(pipeline, metric) for metric in metrics] for pipeline in pipelines],
+                    dtype=float).reshape(len(pipelines), len(metrics))
+
+
+def compute_row_orders(pipelines, metrics):
+    # Replicates PipelineMatrixBundle.computeSortedPipelines: descending normalized score (0 if missing), and by source
+    # (sources ordered by their best pipeline, then by score). Rows without a normalized score (NaN) are sorted last,
+    # javascript does not order them consistently
+    sources = np.array([pipeline['pipeline_source']['name'].split("#")[0] for pipeline in pipelines])
+    all_scores = extract_metric_scores(pipelines, metrics)
+    orders = {}
+    for column, metric in enumerate(metrics):
+        scores = all_scores[:, column]
+        score_order = np.argsort(-scores, kind='stable')
+        _, source_codes = np.unique(sources[score_order], return_inverse=True)
+        source_rank = np.full(source_codes.max() + 1 if len(source_codes) else 0, len(pipelines))
+        np.minimum.at(source_rank, source_codes, np.arange(len(pipelines)))
+        orders[(SORT_BY_SCORE, metric)] = score_order
+        orders[(SORT_BY_SOURCE, metric)] = score_order[np.argsort(source_rank[source_codes], kind='stable')]
+    return orders
+
+
+def register_paged_plot(plot_id):
+    plot = get_plot(plot_id)
+    plot['orders'] = compute_row_orders(plot['pipelines'], extract_metric_names(plot['pipelines']))
+
+
+def get_pipeline_page(plot_id, sort_by, metric, offset, limit):
+    # Returns the rows [offset, offset + limit) of the plot sorted by `sort_by` and `metric`, and the number of rows
+    plot = get_plot(plot_id)
+    order = plot['orders'][(sort_by, metric)]
+    return [plot['pipelines'][idx] for idx in order[offset:offset + limit]], len(order)
+
+
+def prepare_paged_data(data, plot_id, page_size):
+    # Keeps the first page of rows (by the first metric) in the plot data, and computes the row orders for the comm api.
+    # The pipelines must be registered with register_plot
+    metrics = extract_metric_names(data['pipelines'])
+    if not metrics:
+        return data
+    register_paged_plot(plot_id)
+    rows, total = get_pipeline_page(plot_id, SORT_BY_SCORE, metrics[0], 0, page_size)
+    paged = dict(data)
+    paged['pipelines'] = rows
+    paged['paging'] = {'plot_id': plot_id, 'page_size': page_size, 'total': total, 'metrics': metrics}
+    return paged
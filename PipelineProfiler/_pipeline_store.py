@@ -0,0 +1,95 @@
+import json
+import sqlite3
+
+#####
+# On-disk store of merged pipelines (SQLite), indexed by problem id and pipeline digest
+#
+# Usage:
+#
+# python pipeline_merge.py pipeline_runs.json pipelines.json pipelines.sqlite --sqlite
+#
+# from PipelineProfiler._pipeline_store import list_store_problems, load_problem_pipelines
+# list_store_problems("pipelines.sqlite") # {<problem id>: <number of pipelines>}
+# pipelines = load_problem_pipelines("pipelines.sqlite", "185_baseball_problem")
+# pipelines = find_store_pipeline_digest("pipelines.sqlite", [pipeline_digest, ...])
+# PipelineProfiler.plot_pipeline_matrix(pipelines)
+
+BATCH_SIZE = 1000 # rows inserted per statement, and digests per query (SQLite limits the number of variables)
+
+
+def connect_store(path):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS pipelines (problem_id TEXT, pipeline_digest TEXT, data TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS pipelines_problem ON pipelines (problem_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS pipelines_digest ON pipelines (pipeline_digest)")
+    return connection
+
+
+def get_problem_id(pipeline):
+    problem = pipeline.get('problem')
+    return problem.get('id') if isinstance(problem, dict) else problem
+
+
+def write_pipeline_store(path, pipelines):
+    # Writes the pipelines (any iterable, e.g. a generator of merged pipelines) to the store at path, replacing the
+    # pipelines already stored there. Returns the number of pipelines written.
+    n_written = 0
+    connection = connect_store(path)
+    try:
+        connection.execute("DELETE FROM pipelines") # committed with the new pipelines
+        batch = []
+        for pipeline in pipelines:
+            batch.append((get_problem_id(pipeline), pipeline['pipeline_digest'], json.dumps(pipeline)))
+            if len(batch) == BATCH_SIZE:
+                connection.executemany("INSERT INTO pipelines VALUES (?, ?, ?)", batch)
+                n_written += len(batch)
+                batch = []
+        connection.executemany("INSERT INTO pipelines VALUES (?, ?, ?)", batch)
+        n_written += len(batch)
+        connection.commit()
+    finally:
+        connection.close()
+    return n_written
+
+
+def list_store_problems(path):
+    # Returns {<problem id>: <number of pipelines>}
+    connection = connect_store(path)
+    try:
+        return dict(connection.execute("SELECT problem_id, COUNT(*) FROM pipelines GROUP BY problem_id"))
+    finally:
+        connection.close()
+
+
+def load_problem_pipelines(path, problem_id):
+    # Returns the pipelines of one problem, in insertion order
+    connection = connect_store(path)
+    try:
+        rows = connection.execute("SELECT data FROM pipelines WHERE problem_id = ? ORDER BY rowid", (problem_id,))
+        return [json.loads(data) for data, in rows]
+    finally:
+        connection.close()
+
+
+def load_pipelines_by_digest(path, digests):
+    # Returns the pipelines with any of the digests, in insertion order
+    digests = list(set(digests))
+    connection = connect_store(path)
+    try:
+        rows = []
+        for idx in range(0, len(digests), BATCH_SIZE):
+            batch = digests[idx:idx + BATCH_SIZE]
+            rows.extend(connection.execute(
+                "SELECT rowid, data FROM pipelines WHERE pipeline_digest IN ({})".format(",".join("?" * len(batch))),
+                batch))
+        return [json.loads(data) for _, data in sorted(rows)]
+    finally:
+        connection.close()
+
+
+def find_store_pipeline_digest(path, digest):
+    # Same as _helpers.find_pipeline_digest for the pipelines of a store, using its digest index
+    if type(digest) != list:
+        digest = [digest]
+    return load_pipelines_by_digest(path, digest)
@@ -1,37 +1,76 @@
-import pkg_resources
 import string
 import numpy as np
-from dateutil.parser import parse
 import json
 import networkx as nx
-from ._graph_matching import pipeline_to_graph, merge_multiple_graphs
-from ._powerset_analysis import compute_group_importance
+from ._merge_cache import merge_pipelines
+from ._powerset_analysis import compute_group_importance, compute_primitive_importances
+from ._primitive_incidence import extract_primitive_incidence
 from ._comm_api import setup_comm_api
+from ._compact_payload import encode_compact_payload
+from ._timestamps import compute_durations
+from ._pipeline_pages import prepare_paged_data, get_pipeline_page, extract_metric_names
+from ._hyperparameter_index import register_hyperparameter_index, compute_primitive_hyperparameter_data, get_pipeline_hyperparams
+from ._plot_registry import register_plot, get_plot, resolve_pipelines, MissingPlotError
+from ._js_bundle import make_bundle_script, make_render_script
 from collections import defaultdict
-import copy
 
 exportedPipelines = []
 
+def get_message_pipelines(msg):
+    # Plots created by plot_pipeline_matrix reference their pipelines by digest, other plots send the pipelines
+    if 'pipeline_digests' in msg:
+        return resolve_pipelines(msg['plot_id'], msg['pipeline_digests'])
+    return msg['pipelines']
+
+def reply_missing_plot(callback):
+    # Comm handler replying {'error': ..., 'missing_plot': True} when the pipelines of the plot are not registered
+    # anymore, the frontend then sends the pipelines instead of their digests (or shows the error)
+    def handler(msg):
+        try:
+            return callback(msg)
+        except MissingPlotError as error:
+            return {"error": error.args[0], "missing_plot": True}
+    return handler
+
+def extract_metric_values(pipelines, metric):
+    # Same as extractMetric in js/helpers.js
+    return [pipeline['score_map'][metric]['value'] if metric in pipeline['score_map'] else 0 for pipeline in pipelines]
+
 def comm_powerset_analysis(msg):
-    pipelines = msg['pipelines']
-    scores = msg['scores']
-    analysis = compute_group_importance(pipelines, scores, 2)
+    pipelines = get_message_pipelines(msg)
+    scores = extract_metric_values(pipelines, msg['metric'])
+    analysis = compute_group_importance(pipelines, scores, 3, min_support=1)
     return {"analysis": analysis}
-setup_comm_api('powerset_analysis_comm_api', comm_powerset_analysis)
+setup_comm_api('powerset_analysis_comm_api', reply_missing_plot(comm_powerset_analysis), asynchronous=True)
 
 def comm_merge_graphs(msg):
-    pipelines = msg['pipelines']
-    graphs = [pipeline_to_graph(pipeline, pipeline['pipeline_digest']) for pipeline in pipelines]
-    merged = merge_multiple_graphs(graphs)
+    merged = merge_pipelines(get_message_pipelines(msg))
     data_dict = nx.readwrite.json_graph.node_link_data(merged)
     return {"merged": data_dict}
-setup_comm_api('merge_graphs_comm_api', comm_merge_graphs)
+setup_comm_api('merge_graphs_comm_api', reply_missing_plot(comm_merge_graphs), asynchronous=True)
+
+def comm_pipeline_pages(msg):
+    rows, total = get_pipeline_page(msg['plot_id'], msg['sort_by'], msg['metric'], msg['offset'], msg['limit'])
+    include_hyperparams = not get_plot(msg['plot_id'])['hyperparams_on_demand']
+    rows = encode_compact_payload({"pipelines": rows}, include_hyperparams=include_hyperparams, numeric_arrays=True)
+    return {"rows": rows, "offset": msg['offset'],
+            "total": total, "replace": msg.get('replace', False)}
+setup_comm_api('pipeline_pages_comm_api', reply_missing_plot(comm_pipeline_pages))
+
+def comm_hyperparams(msg):
+    # Hyperparameter table of an expanded primitive, or hyperparameters of the steps of a pipeline
+    if 'python_path' in msg:
+        table = compute_primitive_hyperparameter_data(msg['plot_id'], msg['python_path'], msg['pipeline_digests'])
+        return {"python_path": msg['python_path'], "table": table}
+    hyperparams = get_pipeline_hyperparams(msg['plot_id'], msg['pipeline_digest'])
+    return {"pipeline_digest": msg['pipeline_digest'], "hyperparams": hyperparams}
+setup_comm_api('hyperparams_comm_api', reply_missing_plot(comm_hyperparams))
 
 def comm_export_pipelines(msg):
     global exportedPipelines
-    exportedPipelines = msg['pipelines']
+    exportedPipelines = get_message_pipelines(msg)
     return {}
-setup_comm_api('export_pipelines_comm_api', comm_export_pipelines)
+setup_comm_api('export_pipelines_comm_api', reply_missing_plot(comm_export_pipelines))
 
 def get_exported_pipelines():
     global exportedPipelines
@@ -45,44 +84,28 @@ def id_generator(size=15):
     return ''.join(np.random.choice(chars, size, replace=True))
 
 
-def make_html(data_dict, id):
-	lib_path = pkg_resources.resource_filename(__name__, "build/pipelineVis.js")
-	bundle = open(lib_path, "r", encoding="utf8").read()
+def make_html(data_dict, id, standalone=False):
 	html_all = """
 	<html>
 	<head>
 	</head>
 	<body>
-	    <script>
 	    {bundle}
-	    </script>
 	    <div id="{id}">
 	    </div>
-	    <script>
-	        pipelineVis.renderPipelineMatrixBundle("#{id}", {data_dict});
-	    </script>
+	    {render}
 	</body>
 	</html>
-	""".format(bundle=bundle, id=id, data_dict=json.dumps(data_dict))
+	""".format(bundle=make_bundle_script(standalone), id=id,
+	           render=make_render_script(id, 'renderPipelineMatrixBundle("#{}", {})'.format(id, json.dumps(data_dict))))
 	return html_all
 
 def extract_primitive_names(pipeline):
     return [s['primitive']['python_path'] for s in pipeline['steps']]
 
 def extract_module_matrix(pipelines):
-    from sklearn import preprocessing
-    import numpy as np
-    le = preprocessing.LabelEncoder()
-    all_primitives = set()
-    for pipeline in pipelines:
-        all_primitives = all_primitives.union(extract_primitive_names(pipeline))
-    le.fit(list(all_primitives))
-    data_matrix = np.zeros([len(pipelines), len(le.classes_)])
-    for i, pipeline in enumerate(pipelines):
-        for j, primitive in enumerate(extract_primitive_names(pipeline)):
-            idx_primitive = le.transform([primitive])
-            data_matrix[i, idx_primitive] = 1
-    return data_matrix, le.classes_
+    incidence, primitives = extract_primitive_incidence(pipelines)
+    return incidence.toarray().astype(float), primitives
 
 def extract_scores(pipelines):
     scores = []
@@ -125,8 +148,6 @@ def transform_module_type(module_type):
         return ' '.join([n.capitalize() for n in module_type.split("_")])
 
 def extract_primitive_info(pipelines, manual_primitive_types=None):
-    module_matrix, module_names = extract_module_matrix(pipelines)
-    scores = extract_scores(pipelines)
     infos = {}
     module_types = set()
     for pipeline in pipelines:
@@ -150,15 +171,18 @@ def extract_primitive_info(pipelines, manual_primitive_types=None):
     return infos, module_types
 
 def extract_d3m_time_metric(pipelines):
-    for pipeline in pipelines:
-        if 'end' in pipeline and 'start' in pipeline: # using D3M prediction time format
-            diff = parse(pipeline['end']) - parse(pipeline['start'])
-            diff_sec = diff.total_seconds()
-            pipeline['scores'].append({
-                'metric': {'metric': 'PRED TIME (s)'},
-                'normalized': diff_sec,
-                'value': diff_sec,
-            })
+    # using D3M prediction time format. The duration is precomputed by pipeline_merge.py (prediction_time), or computed
+    # from start and end
+    timed = [pipeline for pipeline in pipelines if 'prediction_time' in pipeline or ('end' in pipeline and 'start' in pipeline)]
+    missing = [pipeline for pipeline in timed if 'prediction_time' not in pipeline]
+    durations = iter(compute_durations([pipeline['start'] for pipeline in missing], [pipeline['end'] for pipeline in missing]))
+    for pipeline in timed:
+        diff_sec = pipeline['prediction_time'] if 'prediction_time' in pipeline else next(durations)
+        pipeline['scores'].append({
+            'metric': {'metric': 'PRED TIME (s)'},
+            'normalized': diff_sec,
+            'value': diff_sec,
+        })
 
 def compute_metric_map(pipelines):
     for pipeline in pipelines:
@@ -166,8 +190,15 @@ def compute_metric_map(pipelines):
         for score in pipeline['scores']:
             pipeline['score_map'][score['metric']['metric']] = score            
 
+def copy_pipeline_records(pipelines):
+    # Shallow copies of the pipelines, with new containers for the fields modified by extract_d3m_time_metric,
+    # compute_metric_map and rename_pipelines. Steps, hyperparams and scores are shared with the input pipelines,
+    # which are not modified.
+    return [dict(pipeline, scores=list(pipeline['scores']), pipeline_source=dict(pipeline['pipeline_source']))
+            for pipeline in pipelines]
+
 def prepare_data_pipeline_matrix(pipelines, manual_primitive_types=None):
-    pipelines = copy.deepcopy(pipelines)
+    pipelines = copy_pipeline_records(pipelines)
     extract_d3m_time_metric(pipelines)
     compute_metric_map(pipelines)
     pipelines = sorted(pipelines, key=lambda x: x['scores'][0]['normalized'], reverse=True)
@@ -178,18 +209,34 @@ def prepare_data_pipeline_matrix(pipelines, manual_primitive_types=None):
         "infos": info,
         "pipelines": pipelines,
         "module_types": list(module_types),
+        # importances of all primitives, for all metrics, of the complete set of pipelines
+        "importances": compute_primitive_importances(pipelines, extract_metric_names(pipelines)),
     }
     return data
 
 def get_pipeline_profiler_html(pipelines):
     id = id_generator()
-    data_dict = prepare_data_pipeline_matrix(pipelines)
-    html_all = make_html(data_dict, id)
+    data_dict = encode_compact_payload(prepare_data_pipeline_matrix(pipelines))
+    html_all = make_html(data_dict, id, standalone=True)
     return html_all
     
-def plot_pipeline_matrix(pipelines, manual_primitive_types=None):
+def plot_pipeline_matrix(pipelines, manual_primitive_types=None, page_size=None, hyperparams_on_demand=False):
+    # page_size: If set, only the best `page_size` pipelines are sent to the plot initially, and the next ones are loaded
+    # on demand
+    # hyperparams_on_demand: If True, hyperparameters are not sent to the plot, they are requested from this kernel when
+    # needed (smaller output, but the hyperparameters are not available after a kernel restart or in saved notebooks)
     from IPython.core.display import display, HTML
     id = id_generator()
     data_dict = prepare_data_pipeline_matrix(pipelines, manual_primitive_types)
+    # the comm messages of the plot reference the registered pipelines
+    register_plot(id, data_dict['pipelines'], hyperparams_on_demand=hyperparams_on_demand)
+    if hyperparams_on_demand:
+        register_hyperparameter_index(id)
+    if page_size is not None and len(pipelines) > page_size:
+        data_dict = prepare_paged_data(data_dict, id, page_size)
+    data_dict['plot_id'] = id
+    if hyperparams_on_demand:
+        data_dict['hyperparams_on_demand'] = True
+    data_dict = encode_compact_payload(data_dict, include_hyperparams=not hyperparams_on_demand)
     html_all = make_html(data_dict, id)
     display(HTML(html_all))
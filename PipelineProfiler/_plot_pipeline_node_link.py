@@ -1,8 +1,8 @@
-import pkg_resources
 import string
 import numpy as np
 import json
 import networkx as nx
+from ._js_bundle import make_bundle_script, make_render_script
 
 def id_generator(size=15):
     """Helper function to generate random div ids. This is useful for embedding
@@ -11,25 +11,21 @@ def id_generator(size=15):
     return ''.join(np.random.choice(chars, size, replace=True))
 
 
-def make_html(data_dict, draw_function):
-	lib_path = pkg_resources.resource_filename(__name__, "build/pipelineVis.js")
-	bundle = open(lib_path).read()
+def make_html(data_dict, draw_function, standalone=False):
+	id = id_generator()
 	html_all = """
 	<html>
 	<head>
 	</head>
 	<body>
-	    <script>
 	    {bundle}
-	    </script>
 	    <div id="{id}">
 	    </div>
-	    <script>
-	        pipelineVis.{draw_function}("#{id}", {data_dict});
-	    </script>
+	    {render}
 	</body>
 	</html>
-	""".format(bundle=bundle, draw_function=draw_function, id=id_generator(), data_dict=json.dumps(data_dict))
+	""".format(bundle=make_bundle_script(standalone), id=id,
+	           render=make_render_script(id, '{}("#{}", {})'.format(draw_function, id, json.dumps(data_dict))))
 	return html_all
 
 def plot_pipeline_node_link(data_dict):
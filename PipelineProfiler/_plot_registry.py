@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import threading
+
+#####
+# Pipelines of the plots created by plot_pipeline_matrix
+#
+# The comm messages of a plot reference its pipelines by plot id and pipeline_digest, instead of sending them back to
+# Python. The comm apis (pipeline pages, hyperparameters) also keep their per plot data in the plot entry.
+# Only the most recently created plots are kept (see set_max_registered_plots). The comm apis reply with an error to
+# requests of older plots, and the frontend sends the pipelines instead when it can.
+#
+# Usage:
+#
+# register_plot(plot_id, pipelines)
+# pipelines = resolve_pipelines(plot_id, [pipeline_digest, ...])
+# PipelineProfiler.set_max_registered_plots(None) # keep the pipelines of every plot
+
+MAX_REGISTERED_PLOTS = 256 # the pipelines of the most recently created plots are kept, None for all plots
+
+_plots = OrderedDict() # plot id -> {'pipelines': [...], 'by_digest': {pipeline_digest: pipeline}, 'hyperparams_on_demand': bool, ...}
+_plots_lock = threading.Lock() # the comm apis run on worker threads
+
+
+class MissingPlotError(KeyError):
+    pass
+
+
+def set_max_registered_plots(max_plots):
+    # max_plots: number of plots whose pipelines are kept for their comm apis, or None for no limit
+    global MAX_REGISTERED_PLOTS
+    with _plots_lock:
+        MAX_REGISTERED_PLOTS = max_plots
+        evict_plots()
+
+
+def evict_plots():
+    # Called with _plots_lock held
+    while MAX_REGISTERED_PLOTS is not None and len(_plots) > MAX_REGISTERED_PLOTS:
+        _plots.popitem(last=False)
+
+
+def register_plot(plot_id, pipelines, hyperparams_on_demand=False):
+    # hyperparams_on_demand: the plot does not have the hyperparameters, they are served by the hyperparams_comm_api
+    plot = {
+        'pipelines': pipelines,
+        'hyperparams_on_demand': hyperparams_on_demand,
+        'by_digest': {pipeline['pipeline_digest']: pipeline for pipeline in pipelines},
+    }
+    with _plots_lock:
+        _plots[plot_id] = plot
+        evict_plots()
+    return plot
+
+
+def get_plot(plot_id):
+    with _plots_lock:
+        plot = _plots.get(plot_id)
+    if plot is None:
+        raise MissingPlotError("Pipelines of plot {} are not available anymore, please plot them again".format(plot_id))
+    return plot
+
+
+def resolve_pipelines(plot_id, pipeline_digests):
+    by_digest = get_plot(plot_id)['by_digest']
+    return [by_digest[digest] for digest in pipeline_digests]
@@ -1,24 +1,23 @@
-from itertools import combinations, chain
-from collections import defaultdict
-from sklearn import preprocessing
+from itertools import combinations, islice, repeat
+import os
+import tempfile
 import numpy as np
-from scipy.stats import pointbiserialr
+from ._parallel import resolve_n_jobs, make_executor
+from ._pipeline_pages import extract_metric_scores
+from ._primitive_incidence import extract_primitive_incidence
+
+BATCH_SIZE_BYTES = 2 ** 26 # memory budget of the group indicator columns evaluated at once
+
+# Batched products can round differently for identical indicator columns,
+# so a group must beat its subgroups by more than this to be kept
+IMPORTANCE_TOLERANCE = 1e-12
 
 def extract_primitive_names(pipeline):
     return [s['primitive']['python_path'] for s in pipeline['steps']]
 
 def extract_primitive_matrix(pipelines):
-    le = preprocessing.LabelEncoder()
-    all_primitives = set()
-    for pipeline in pipelines:
-        all_primitives = all_primitives.union(extract_primitive_names(pipeline))
-    le.fit(list(all_primitives))
-    data_matrix = np.zeros([len(pipelines), len(le.classes_)], dtype=int)
-    for i, pipeline in enumerate(pipelines):
-        for j, primitive in enumerate(extract_primitive_names(pipeline)):
-            idx_primitive = le.transform([primitive])
-            data_matrix[i, idx_primitive] = 1
-    return data_matrix, le.classes_
+    incidence, primitives = extract_primitive_incidence(pipelines)
+    return incidence.toarray().astype(int), primitives
 
 def extract_scores(pipelines):
     scores = []
@@ -28,28 +27,213 @@ def extract_scores(pipelines):
     return scores
 
 
-def compute_group_importance(pipelines, scores, up_to_k=5):
-    primitive_matrix, primitives = extract_primitive_matrix(pipelines)
-    column_idx_map = {p: idx for idx, p  in enumerate(primitives)}
-    importances = {}
-    for k in range(1, up_to_k+1):
-        for selected_columns in combinations(primitives, k):
-            selected_columns_idx = np.array([column_idx_map[c] for c in selected_columns])
-            sub_matrix = primitive_matrix[:, selected_columns_idx]
-            used_all = np.prod(sub_matrix, axis = 1)
-            importance, _  = pointbiserialr(used_all, scores)
-            importance = 0 if np.isnan(importance) else importance
-            importances[frozenset(selected_columns)] = importance
-
-    # keeping only the ones for which importance is greater than those of its component parts
+def iter_group_batches(n_primitives, k, batch_size, leading_column=None):
+    # Yields all groups of k primitive columns, in `combinations` order, as (batch_size x k) arrays.
+    # If leading_column is set, only the groups starting with it
+    if leading_column is None:
+        groups = combinations(range(n_primitives), k)
+    else:
+        groups = ((leading_column,) + rest for rest in combinations(range(leading_column + 1, n_primitives), k - 1))
+    while True:
+        batch = np.array(list(islice(groups, batch_size)), dtype=np.intp).reshape(-1, k)
+        if len(batch) == 0:
+            return
+        yield batch
+
+def compute_batch_correlation(primitive_columns, centered_scores, groups):
+    # Point-biserial correlation between the scores and "pipeline uses all primitives of the group", for a batch of groups.
+    # primitive_columns: boolean (pipelines x primitives) incidence matrix
+    # centered_scores: pipeline scores minus their mean
+    # groups: (n_groups x k) array of primitive columns
+    # Returns the correlations and the number of pipelines using each group
+    used_all = primitive_columns[:, groups[:, 0]]
+    for column in range(1, groups.shape[1]):
+        used_all &= primitive_columns[:, groups[:, column]]
+    n_used = used_all.sum(axis=0)
+    covariance = centered_scores @ used_all
+    return point_biserial_correlation(covariance, n_used, centered_scores), n_used
+
+def point_biserial_correlation(covariance, n_used, centered_scores):
+    # covariance: sum of the centered scores of the pipelines using each group
+    # n_used: number of pipelines using each group
+    # centered_scores can also be a (pipelines x metrics) matrix, with a (groups x metrics) covariance
+    n = len(centered_scores)
+    if centered_scores.ndim == 1:
+        sum_squares = np.dot(centered_scores, centered_scores)
+    else:
+        sum_squares = np.einsum('ij,ij->j', centered_scores, centered_scores)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.sqrt(np.multiply.outer(n_used * (n - n_used) / n, sum_squares))
+    correlation[~np.isfinite(correlation)] = 0 # groups used by none or all pipelines
+    return np.clip(correlation, -1, 1)
+
+def evaluate_groups(primitive_columns, centered_scores, batches, min_support):
+    # Returns [(group, importance)] for the groups used by at least `min_support` pipelines
+    evaluated = []
+    for groups in batches:
+        correlation, n_used = compute_batch_correlation(primitive_columns, centered_scores, groups)
+        supported = n_used >= min_support
+        evaluated.extend(zip(map(tuple, groups[supported].tolist()), correlation[supported].tolist()))
+    return evaluated
+
+def evaluate_leading_groups(primitive_columns, centered_scores, k, leading_column, batch_size):
+    # Returns [(group, importance)] for the groups of size k starting with `leading_column` used by some pipeline
+    batches = iter_group_batches(primitive_columns.shape[1], k, batch_size, leading_column)
+    return evaluate_groups(primitive_columns, centered_scores, batches, 1)
+
+def evaluate_group_lattice(indptr, indices, centered_scores, n_primitives, leading_columns, up_to_k, min_support):
+    # Grows the lattice of groups starting with one of `leading_columns` level by level, only expanding groups used by
+    # at least `min_support` pipelines. The pipelines using every group of a level are kept, so the next level is
+    # evaluated from the primitives of those pipelines only.
+    # indptr, indices: CSR structure of the pipelines x primitives incidence matrix
+    # Returns, for every group size, [(group, importance)] in lexicographic order
+    n_pipelines = len(indptr) - 1
+    # Starting from the empty group, used by all pipelines.
+    # group_rows lists the pipelines using each group, group_ids the group of each of these entries (sorted)
+    groups = np.zeros([1, 0], dtype=np.intp)
+    group_rows = np.arange(n_pipelines)
+    group_ids = np.zeros(n_pipelines, dtype=np.intp)
+    levels = []
+    for k in range(1, up_to_k + 1):
+        # primitives of the pipelines using each group
+        starts = indptr[group_rows]
+        lengths = indptr[group_rows + 1] - starts
+        entries = np.repeat(np.arange(len(group_rows)), lengths)
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        columns = indices[positions]
+        owners = group_ids[entries]
+        if k == 1:
+            extends = np.isin(columns, leading_columns)
+        else:
+            extends = columns > groups[owners, -1] # groups are sorted tuples
+        entries, owners, columns = entries[extends], owners[extends], columns[extends]
+
+        # counting pipelines and summing their scores for every extended group. Keys are sorted by group, then column
+        keys, key_index, n_used = np.unique(owners * n_primitives + columns, return_inverse=True, return_counts=True)
+        covariance = np.bincount(key_index, weights=centered_scores[group_rows[entries]], minlength=len(keys))
+        supported = n_used >= min_support
+        keys = keys[supported]
+        extended_groups = np.hstack([groups[keys // n_primitives], (keys % n_primitives)[:, None]])
+        importances = point_biserial_correlation(covariance[supported], n_used[supported], centered_scores)
+        levels.append(list(zip(map(tuple, extended_groups.tolist()), importances.tolist())))
+        if len(keys) == 0 or k == up_to_k:
+            break
+
+        # pipelines using every supported group, for the next level
+        extended_ids = np.cumsum(supported) - 1
+        kept = supported[key_index]
+        order = np.argsort(extended_ids[key_index[kept]], kind='stable')
+        group_rows = group_rows[entries[kept]][order]
+        group_ids = extended_ids[key_index[kept]][order]
+        groups = extended_groups
+    return levels
+
+def filter_improving_groups(importances):
+    # Keeps the groups whose importance is greater than those of all their subgroups.
+    # importances: {group: importance}, ordered by group size. Every subgroup of a group must be present.
+    # The best subgroup importance of a group is looked up from its parents (subgroups one primitive smaller)
+    best_subgroup = {}
     kept = []
-    for selected_columns in importances.keys():
-        if (len(selected_columns) > 1):
-            to_add = True
-            for subgroup in chain(*[list(combinations(selected_columns, take)) for take in range(1, len(selected_columns))]):
-                if abs(importances[frozenset(subgroup)]) >= abs(importances[selected_columns]):
-                    to_add = False
-                    break
-            if to_add:
-                kept.append({'importance':importances[selected_columns], 'group': list(selected_columns)})
-    return sorted(kept, key=lambda x:abs(x['importance']), reverse=True)
\ No newline at end of file
+    for group, importance in importances.items():
+        if len(group) == 1:
+            best_subgroup[group] = 0
+            continue
+        best = 0
+        for i in range(len(group)):
+            parent = group[:i] + group[i + 1:]
+            best = max(best, abs(importances[parent]), best_subgroup[parent])
+        best_subgroup[group] = best
+        if best < abs(importance) - IMPORTANCE_TOLERANCE:
+            kept.append((group, importance))
+    return kept
+
+_shared_arrays = {}
+
+def load_shared_array(path):
+    # Memory-mapped arrays are opened once per worker process
+    if path not in _shared_arrays:
+        _shared_arrays[path] = np.load(path, mmap_mode='r')
+    return _shared_arrays[path]
+
+def run_shared_task(function, paths, task):
+    arrays = [load_shared_array(path) for path in paths]
+    return function(*arrays, *task)
+
+def run_partitioned(function, arrays, tasks, n_jobs=None):
+    # Returns [function(*arrays, *task) for task in tasks], running the tasks in a process pool of n_jobs workers (see
+    # _parallel.py). The arrays are saved once and memory-mapped by the workers, so they are not copied to every task.
+    n_workers = resolve_n_jobs(n_jobs, len(tasks))
+    if n_workers is None:
+        return [function(*arrays, *task) for task in tasks]
+    with tempfile.TemporaryDirectory() as shared_dir:
+        paths = []
+        for idx, array in enumerate(arrays):
+            path = os.path.join(shared_dir, 'array_{}.npy'.format(idx))
+            np.save(path, array)
+            paths.append(path)
+        chunksize = max(1, len(tasks) // (4 * n_workers))
+        with make_executor(n_workers) as executor:
+            return list(executor.map(run_shared_task, repeat(function), repeat(paths), tasks, chunksize=chunksize))
+
+def compute_group_importance(pipelines, scores, up_to_k=5, min_support=None, n_jobs=None):
+    # Importance of groups of up to `up_to_k` primitives that are more important than all their subgroups.
+    # min_support: if None, evaluates every combination of primitives. Otherwise, grows the groups level by level
+    #   (Apriori-style), only expanding groups used by at least `min_support` pipelines. min_support=1 gives the same
+    #   result as the exhaustive search, larger values also drop rare groups.
+    # n_jobs: number of worker processes (-1 for all cores, see _parallel.py). The groups are partitioned by their leading primitive,
+    #   the results are the same as the serial computation.
+    incidence, primitives = extract_primitive_incidence(pipelines)
+    scores = np.asarray(scores, dtype=float)
+    if len(scores) < 2 or np.all(scores == scores[0]):
+        centered_scores = np.zeros(len(scores)) # correlation is undefined, all importances are 0
+    else:
+        centered_scores = scores - scores.mean()
+
+    # Groups used by no pipeline have importance 0 and are never kept, storing only the supported ones
+    importances = {}
+    if min_support is None:
+        primitive_columns = incidence.toarray().astype(bool)
+        batch_size = max(1, BATCH_SIZE_BYTES // (8 * max(1, len(scores))))
+        tasks = [(k, column, batch_size) for k in range(1, up_to_k+1) for column in range(len(primitives))]
+        for evaluated in run_partitioned(evaluate_leading_groups, [primitive_columns, centered_scores], tasks, n_jobs):
+            importances.update(evaluated)
+    else:
+        if resolve_n_jobs(n_jobs) is None:
+            tasks = [(len(primitives), np.arange(len(primitives)), up_to_k, min_support)]
+        else:
+            tasks = [(len(primitives), [column], up_to_k, min_support) for column in range(len(primitives))]
+        arrays = [incidence.indptr, incidence.indices, centered_scores]
+        levels = [[] for _ in range(up_to_k)]
+        for task_levels in run_partitioned(evaluate_group_lattice, arrays, tasks, n_jobs):
+            for k, level in enumerate(task_levels):
+                levels[k].extend(level)
+        for level in levels:
+            importances.update(level)
+
+    kept = [{'importance': importance, 'group': [primitives[c] for c in group]} for group, importance in filter_improving_groups(importances)]
+    return sorted(kept, key=lambda x:abs(x['importance']), reverse=True)
+
+
+def compute_primitive_importances(pipelines, metrics):
+    # Importance of every primitive for every metric, same as computePrimitiveImportances in js/helpers.js:
+    # point-biserial correlation between the normalized scores (0 if the metric is missing) and the primitive usage.
+    # As d3's mean and deviation, the means and the deviation skip the scores without a normalized value (NaN), but
+    # the group sizes count every pipeline. Returns {metric: {python_path: importance}}
+    incidence, primitives = extract_primitive_incidence(pipelines)
+    scores = extract_metric_scores(pipelines, metrics)
+    valid = ~np.isnan(scores)
+    n_valid = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centered_scores = np.where(valid, scores - np.nansum(scores, axis=0) / n_valid, 0)
+        deviation = np.sqrt(np.einsum('ij,ij->j', centered_scores, centered_scores) / (n_valid - 1))
+        # correlation is undefined for constant scores, importances are 0
+        constant = np.max(np.where(valid, scores, -np.inf), axis=0, initial=-np.inf) <= np.min(np.where(valid, scores, np.inf), axis=0, initial=np.inf)
+        deviation[constant] = np.nan
+        n_used = np.asarray(incidence.sum(axis=0)).ravel()
+        n_valid_used = np.asarray(incidence.T @ valid.astype(float))
+        sum_used = np.asarray(incidence.T @ centered_scores)
+        mean_difference = sum_used / n_valid_used + sum_used / (n_valid - n_valid_used) # the centered scores sum to 0
+        n = len(pipelines)
+        correlation = mean_difference / deviation * np.sqrt(n_used * (n - n_used) / (n * (n - 1)))[:, None]
+    correlation[~np.isfinite(correlation)] = 0
+    return {metric: dict(zip(primitives.tolist(), correlation[:, column].tolist())) for column, metric in enumerate(metrics)}
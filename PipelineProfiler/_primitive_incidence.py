@@ -0,0 +1,39 @@
+import numpy as np
+from scipy import sparse
+
+#####
+# Pipelines x primitives incidence index
+#
+# Usage:
+#
+# from PipelineProfiler._primitive_incidence import extract_primitive_incidence
+# incidence, primitives = extract_primitive_incidence(pipelines)
+# incidence[i, j] == 1 iff pipelines[i] has a step using primitives[j]
+
+
+def extract_primitive_incidence(pipelines):
+    """Builds the pipelines x primitives incidence matrix in a single pass over the steps.
+    Returns a binary CSR matrix and the sorted primitive vocabulary (same column order as
+    `LabelEncoder.classes_`)."""
+    vocabulary = {}
+    codes = []
+    indptr = [0]
+    for pipeline in pipelines:
+        for step in pipeline['steps']:
+            python_path = step['primitive']['python_path']
+            codes.append(vocabulary.setdefault(python_path, len(vocabulary)))
+        indptr.append(len(codes))
+
+    # Codes are assigned in order of appearance. Remapping them in bulk to the sorted vocabulary.
+    primitives = np.array(sorted(vocabulary), dtype=str)
+    remap = np.empty(len(primitives), dtype=np.int64)
+    remap[[vocabulary[p] for p in primitives]] = np.arange(len(primitives))
+    indices = remap[np.array(codes, dtype=np.int64)]
+
+    incidence = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, np.array(indptr, dtype=np.int64)),
+        shape=(len(pipelines), len(primitives))
+    )
+    incidence.sum_duplicates() # a primitive can be used by multiple steps of the same pipeline
+    incidence.data[:] = 1
+    return incidence, primitives
@@ -1,6 +1,7 @@
 import networkx as nx
 import numpy as np
-from collections import defaultdict
+from scipy import sparse
+from collections import defaultdict, Counter
 
 def node_type(g, node):
     node = g.nodes[node]
@@ -13,19 +14,47 @@ def node_type(g, node):
 def compute_edge_type(g, edge):
     return '.'.join([node_type(g, edge[0]), node_type(g, edge[1])])
 
+def compute_edge_types(g):
+    # {edge: edge type}, computing the type of every node once
+    node_types = {node: node_type(g, node) for node in g.nodes}
+    return {edge: '.'.join([node_types[edge[0]], node_types[edge[1]]]) for edge in g.edges}
+
+def iter_pairwise_edges(g1, g2):
+    # Yields the edges (source, destination, edge type) of the pairwise connectivity graph.
+    # Edges of g2 are bucketed by type, so every edge of g1 is only paired with the edges of g2 of the same type
+    edge_buckets_g2 = defaultdict(list)
+    for edge_g2, type_edge_g2 in compute_edge_types(g2).items():
+        edge_buckets_g2[type_edge_g2].append(edge_g2)
+    for edge_g1, type_edge_g1 in compute_edge_types(g1).items():
+        s1, d1 = edge_g1
+        for s2, d2 in edge_buckets_g2.get(type_edge_g1, []):
+            yield (s1, s2), (d1, d2), type_edge_g1
+            yield (d1, d2), (s1, s2), type_edge_g1
+
 def create_pairwise_conn_graph(g1, g2):
     PCG = nx.DiGraph()
-    for edge_g1 in g1.edges:
-        for edge_g2 in g2.edges:
-            type_edge_g1 = compute_edge_type(g1, edge_g1)
-            type_edge_g2 = compute_edge_type(g2, edge_g2)
-            if (type_edge_g1 == type_edge_g2): # edge the same type
-                s1, d1 = edge_g1
-                s2, d2 = edge_g2
-                PCG.add_edge((s1, s2), (d1, d2), edge_type = type_edge_g1)
-                PCG.add_edge((d1, d2), (s1, s2), edge_type = type_edge_g1)
+    for source, dest, edge_type in iter_pairwise_edges(g1, g2):
+        PCG.add_edge(source, dest, edge_type = edge_type)
     return PCG
 
+def create_propagation_matrix(g1, g2):
+    # Induced propagation graph of g1 and g2 as a sparse matrix, without building the networkx PCG.
+    # The weight of an edge is 1 / <number of edges of the same type leaving its source>.
+    # Returns the PCG nodes and the CSR matrix of weights (row: source, column: destination)
+    edge_types = {}
+    for source, dest, edge_type in iter_pairwise_edges(g1, g2):
+        edge_types[(source, dest)] = edge_type
+    n_edges_same_type = Counter((edge[0], edge_type) for edge, edge_type in edge_types.items())
+    node_index = {}
+    rows, cols, weights = [], [], []
+    for edge, edge_type in edge_types.items():
+        source, dest = edge
+        rows.append(node_index.setdefault(source, len(node_index)))
+        cols.append(node_index.setdefault(dest, len(node_index)))
+        weights.append(1 / n_edges_same_type[(source, edge_type)])
+    propagation = sparse.csr_matrix((weights, (rows, cols)), shape=(len(node_index), len(node_index)))
+    return list(node_index), propagation
+
 def transform_induced_propagation_graph(pcg):
     edges = pcg.edges(data=True)
     edge_dict = defaultdict(lambda : defaultdict(lambda: []))
@@ -48,31 +77,38 @@ def transform_induced_propagation_graph(pcg):
     nx.set_edge_attributes(pcg, edge_weight_map, 'weight')
     return pcg
 
-def similarity_flooding(similarity_matrix, g1, g2, alpha = 0.01, n_iter = 100):
-    pcg = create_pairwise_conn_graph(g1, g2)
-    ipg = transform_induced_propagation_graph(pcg)
+def similarity_flooding(similarity_matrix, g1, g2, alpha = 0.01, n_iter = 100, tol = None, return_stats = False):
+    # Propagates the node similarities of g1 x g2 through the pairwise connectivity graph.
+    # Stops after n_iter iterations, or earlier once the largest change of a similarity is below `tol`.
+    # If return_stats, also returns {'n_iter': <iterations run>, 'residual': <last largest change>}
+    nodes, propagation = create_propagation_matrix(g1, g2)
+    if len(nodes) == 0:
+        raise ValueError("PCG graph has no nodes or edges")
     g1_node_map = {node:idx for idx, node in enumerate(g1.nodes)}
     g2_node_map = {node:idx for idx, node in enumerate(g2.nodes)}
-    adj = nx.adjacency_matrix(pcg, weight='weight').todense()
-    
-    #setting sim weights to ipg graph
-    for node in ipg.nodes:
-        g1_idx = g1_node_map[node[0]]
-        g2_idx = g2_node_map[node[1]]
-        ipg.nodes[node]['similarity'] = similarity_matrix[g1_idx, g2_idx]
-    
+    g1_idx = np.array([g1_node_map[node[0]] for node in nodes])
+    g2_idx = np.array([g2_node_map[node[1]] for node in nodes])
+
     #creating similarity vector
-    similarity_vector = np.reshape(np.array([node[1]['similarity'] for node in ipg.nodes(data=True)]), [-1,1])
-    similarity_vector = similarity_vector / np.max(similarity_vector)
-    for it in range(n_iter):
-        similarity_vector = alpha * np.dot(adj, similarity_vector) + (1-alpha) * similarity_vector
-        similarity_vector = similarity_vector / np.max(similarity_vector)
-    
+    similarity_vector = similarity_matrix[g1_idx, g2_idx].astype(float)
+    scale = np.max(similarity_vector)
+    it = 0
+    residual = 0.0
+    if scale > 0:
+        similarity_vector /= scale
+        for it in range(1, n_iter + 1):
+            flooded = propagation @ similarity_vector
+            flooded *= alpha
+            flooded += (1-alpha) * similarity_vector
+            flooded /= np.max(flooded)
+            residual = float(np.max(np.abs(flooded - similarity_vector)))
+            similarity_vector = flooded
+            if tol is not None and residual < tol:
+                break
+        similarity_vector *= scale
+
     #retrieving sim weights to similarity_matrix
-    for node in ipg.nodes:
-        g1_idx = g1_node_map[node[0]]
-        g2_idx = g2_node_map[node[1]]
-        similarity_matrix[g1_idx, g2_idx] = ipg.nodes[node]['similarity']
-    
+    similarity_matrix[g1_idx, g2_idx] = similarity_vector
+    if return_stats:
+        return similarity_matrix, {'n_iter': it, 'residual': residual}
     return similarity_matrix
-
@@ -0,0 +1,38 @@
+import re
+import numpy as np
+
+#####
+# Durations between ISO 8601 timestamps (e.g. D3M pipeline run "start" and "end")
+#
+# Timestamps without UTC offset (optionally with a "Z" suffix on both ends) are parsed in bulk with numpy.
+# Other formats are parsed with dateutil.
+
+ISO_TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?")
+
+
+def strip_utc(start, end):
+    # Returns the timestamps without "Z" suffix if both are naive or UTC ("Z") ISO timestamps, None otherwise
+    if start.endswith("Z") and end.endswith("Z"):
+        start, end = start[:-1], end[:-1]
+    if ISO_TIMESTAMP.fullmatch(start) and ISO_TIMESTAMP.fullmatch(end):
+        return start, end
+    return None
+
+
+def compute_durations(starts, ends):
+    # Returns the list of durations (end - start) in seconds
+    stripped = [strip_utc(start, end) for start, end in zip(starts, ends)]
+    fast = [idx for idx, timestamps in enumerate(stripped) if timestamps is not None]
+    durations = [None] * len(stripped)
+    if fast:
+        start = np.array([stripped[idx][0] for idx in fast], dtype='datetime64[us]')
+        end = np.array([stripped[idx][1] for idx in fast], dtype='datetime64[us]')
+        # same as timedelta.total_seconds(): microseconds / 10**6
+        for idx, duration in zip(fast, ((end - start) / np.timedelta64(1, 'us') / 10**6).tolist()):
+            durations[idx] = duration
+    if len(fast) < len(durations):
+        from dateutil.parser import parse
+        for idx, timestamps in enumerate(stripped):
+            if timestamps is None:
+                durations[idx] = (parse(ends[idx]) - parse(starts[idx])).total_seconds()
+    return durations
@@ -3,38 +3,127 @@ const COMM_TYPES = {
   COLAB: 'COLAB'
 };
 
+const TYPED_ARRAYS = {
+  float64: Float64Array,
+  float32: Float32Array,
+  int32: Int32Array,
+  uint32: Uint32Array,
+  int16: Int16Array,
+  uint16: Uint16Array,
+  int8: Int8Array,
+  uint8: Uint8Array,
+};
+
+function decodeBase64(text) {
+  const binary = atob(text);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes.buffer;
+}
+
+function decodeArray(description, buffers) {
+  // See encode_arrays in PipelineProfiler/_comm_api.py. 2d arrays are decoded as lists of rows.
+  let bytes;
+  if (description.base64 !== undefined) {
+    bytes = decodeBase64(description.base64);
+  } else {
+    const view = buffers[description.buffer];
+    // copying the bytes, buffers are not aligned to the element size
+    bytes = ArrayBuffer.isView(view) ? view.buffer.slice(view.byteOffset, view.byteOffset + view.byteLength) : view;
+  }
+  const array = new TYPED_ARRAYS[description.dtype](bytes);
+  if (description.shape.length !== 2) {
+    return array;
+  }
+  const [n, m] = description.shape;
+  const rows = [];
+  for (let i = 0; i < n; i++) {
+    rows.push(array.subarray(i * m, (i + 1) * m));
+  }
+  return rows;
+}
+
+export function decodeArrays(data, buffers) {
+  if (Array.isArray(data)) {
+    return data.map(value => decodeArrays(value, buffers));
+  }
+  if (data !== null && typeof data === 'object') {
+    if (data.__ndarray__ !== undefined) {
+      return decodeArray(data.__ndarray__, buffers);
+    }
+    const decoded = {};
+    Object.keys(data).forEach(key => {decoded[key] = decodeArrays(data[key], buffers)});
+    return decoded;
+  }
+  return data;
+}
+
 export default class CommAPI{
-  constructor(api_call_id, callback) {
+  // latestOnly: only the reply to the last call is passed to callback. For Python handlers registered with
+  // setup_comm_api(..., asynchronous=True), which drop superseded requests.
+  constructor(api_call_id, callback, {latestOnly = false} = {}) {
+    this.api_call_id = api_call_id;
     this.callback = callback;
+    this.latestOnly = latestOnly;
+    this.lastRequestId = 0;
     this.mode = null;
+    // Colab runs the calls one at a time. With latestOnly, calls made while waiting for a reply are not sent,
+    // only the last one is sent when the reply arrives.
+    this.colabInFlight = false;
+    this.colabPending = null;
     if (window.Jupyter !== undefined) {
       this.mode = COMM_TYPES.JUPYTER;
       this.comm = window.Jupyter.notebook.kernel.comm_manager.new_comm(api_call_id, {});
       this.comm.on_msg(msg => {
-        const data = msg.content.data;
-        callback(data);
+        this.receive(decodeArrays(msg.content.data, msg.buffers || []));
       });
     } else if (window.google !== undefined) {
       this.mode = COMM_TYPES.COLAB;
-      this.comm = async function(msg){
-        const result = await google.colab.kernel.invokeFunction(
-          api_call_id,
-          [msg], // The argument
-          {}); // kwargs
-        callback(result.data['application/json']);
+      this.comm = async (msg) => {
+        this.colabInFlight = true;
+        let result;
+        try {
+          result = await google.colab.kernel.invokeFunction(
+            api_call_id,
+            [msg], // The argument
+            {}); // kwargs
+        } finally {
+          this.colabInFlight = false;
+        }
+        if (this.colabPending) {
+          const pending = this.colabPending;
+          this.colabPending = null;
+          this.comm(pending);
+        }
+        this.receive(decodeArrays(result.data['application/json'], []));
       };
     } else {
       console.error(new Error("Cannot find Jupyter/Colab namespace from javascript"));
     }
   }
 
+  receive(data) {
+    if (this.latestOnly && data && data.request_id !== undefined && data.request_id !== this.lastRequestId) {
+      return; // stale reply
+    }
+    this.callback(data);
+  }
+
   call(msg) {
     if (this.comm){
+      this.lastRequestId += 1;
+      const request = Object.assign({}, msg, {request_id: this.lastRequestId});
       if (this.mode === COMM_TYPES.JUPYTER){
-        this.comm.send(msg);
+        this.comm.send(request);
       } else if (this.mode === COMM_TYPES.COLAB){
-        this.comm(msg);
+        if (this.latestOnly && this.colabInFlight) {
+          this.colabPending = request;
+        } else {
+          this.comm(request);
+        }
       }
     }
   }
-}
\ No newline at end of file
+}
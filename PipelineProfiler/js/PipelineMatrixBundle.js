@@ -8,6 +8,7 @@ import {schemeCategory10} from "d3-scale-chromatic";
 import {Snackbar, Button, Checkbox, FormControlLabel, IconButton} from "@material-ui/core";
 import CombinatorialImportanceMatrix from "./CombinatorialImportanceMatrix";
 import CommAPI from "./CommAPI";
+import {decodePipelineMatrixData} from "./compactPayload";
 
 import {
   computePrimitiveImportances,
@@ -30,24 +31,56 @@ export class PipelineMatrixBundle extends Component {
     super(props);
     let pipelines = props.data.pipelines;
     let moduleNames = Object.keys(props.data.infos);
-    const metricNames = extractMetricNames(props.data.pipelines);
+    // In paged mode, props.data.pipelines only has the first rows. The others are loaded with commPipelinePages.
+    const paging = props.data.paging || null;
+    const metricNames = paging ? paging.metrics : extractMetricNames(props.data.pipelines);
     let metricOptions = metricNames.map(name => ({type: constants.scoreRequest.D3MSCORE, name}));
     const metricRequest = metricOptions[0];
-    const importances = computePrimitiveImportances(props.data.infos, props.data.pipelines, metricRequest);
+    const importances = this.computeImportances(props.data.pipelines, metricRequest, false);
     const sortColumnsBy = constants.sortModuleBy.importance,
       sortRowsBy = constants.sortPipelineBy.pipeline_score;
 
     pipelines = this.computeSortedPipelines(pipelines, sortRowsBy, metricRequest);
     moduleNames = this.computeSortedModuleNames(moduleNames, sortColumnsBy, importances, this.props.data.infos);
 
+    // Set when python does not have the pipelines of the plot anymore, messages then carry the pipelines
+    this.plotMissing = false;
+
     this.commMergeGraph = new CommAPI('merge_graphs_comm_api', (msg) => {
-      this.setState({ mergedGraph: msg.merged });
-    });
+      if (!this.retryWithPipelines(this.commMergeGraph, msg)) {
+        this.setState({ mergedGraph: msg.merged });
+      }
+    }, {latestOnly: true});
 
-    this.commExportPipelines = new CommAPI('export_pipelines_comm_api', (msg) => {});
+    this.commExportPipelines = new CommAPI('export_pipelines_comm_api', (msg) => {
+      this.retryWithPipelines(this.commExportPipelines, msg);
+    });
 
     this.commPowersetAnalysis = new CommAPI('powerset_analysis_comm_api', (msg) => {
-      this.setState({ powersetAnalysis: msg.analysis })
+      if (!this.retryWithPipelines(this.commPowersetAnalysis, msg)) {
+        this.setState({ powersetAnalysis: msg.analysis })
+      }
+    }, {latestOnly: true});
+
+    this.commPipelinePages = new CommAPI('pipeline_pages_comm_api', (msg) => {
+      if (msg.error) {
+        this.setState({commError: msg.error});
+      } else {
+        this.receivePipelinePage(msg);
+      }
+    });
+
+    // Plots created by plot_pipeline_matrix(..., hyperparams_on_demand=True) do not have hyperparameters, they are
+    // requested with commHyperparams
+    this.hyperparamsOnDemand = !!props.data.hyperparams_on_demand;
+    this.requestedHyperparams = {};
+    this.receivedHyperparams = {}; // pipeline_digest -> hyperparams of each step
+    this.commHyperparams = new CommAPI('hyperparams_comm_api', (msg) => {
+      if (msg.error) {
+        this.setState({commError: msg.error});
+      } else {
+        this.receiveHyperparams(msg);
+      }
     });
 
     this.state = {
@@ -69,11 +102,140 @@ export class PipelineMatrixBundle extends Component {
       sortRowsDropdownHidden: true,
       keepSorted: true,
       exportedPipelineMessage: false,
-      highlightPowersetColumns: []
+      highlightPowersetColumns: [],
+      paging,
+      loadedRows: pipelines.length,
+      removedPipelines: false,
+      commError: null,
     };
 
   }
 
+  makePipelinesMessage(pipelines, msg = {}) {
+    // The pipelines of plots created by plot_pipeline_matrix are kept in Python, messages only reference their digests
+    if (this.props.data.plot_id && !this.plotMissing) {
+      return {...msg, plot_id: this.props.data.plot_id, pipeline_digests: pipelines.map(pipeline => pipeline.pipeline_digest)};
+    }
+    return {...msg, pipelines};
+  }
+
+  callWithPipelines(comm, pipelines, msg = {}) {
+    comm.lastPipelinesCall = {pipelines, msg};
+    comm.call(this.makePipelinesMessage(pipelines, msg));
+  }
+
+  retryWithPipelines(comm, reply) {
+    // Sends the last call of comm again with the pipelines if python replied that it does not have them
+    if (!reply.missing_plot) {
+      return false;
+    }
+    this.plotMissing = true;
+    const {pipelines, msg} = comm.lastPipelinesCall;
+    comm.call(this.makePipelinesMessage(pipelines, msg));
+    return true;
+  }
+
+  computeImportances(pipelines, metricRequest, removedPipelines) {
+    // props.data.importances has the importances of all the pipelines of the plot (including the rows that are not
+    // loaded in paged mode), for every metric. They are recomputed after pipelines are removed from the plot.
+    const precomputed = this.props.data.importances;
+    if (!removedPipelines && precomputed && metricRequest.name in precomputed) {
+      return precomputed[metricRequest.name];
+    }
+    return computePrimitiveImportances(this.props.data.infos, pipelines, metricRequest);
+  }
+
+  requestPipelinePage(offset, limit, replace, sortRowsBy, metricRequest) {
+    // Rows are sorted in python. replace=true replaces the current rows, otherwise rows are appended
+    this.commPipelinePages.call({
+      plot_id: this.state.paging.plot_id,
+      sort_by: sortRowsBy,
+      metric: metricRequest.name,
+      offset,
+      limit,
+      replace,
+    });
+  }
+
+  requestSortedRows(sortRowsBy, metricRequest) {
+    if (this.state.paging) {
+      this.requestPipelinePage(0, this.state.loadedRows, true, sortRowsBy, metricRequest);
+    }
+  }
+
+  computeExpandedPrimitiveData(pipelines, pythonPath) {
+    // Returns null if the data is requested from python (it is set when received)
+    if (this.hyperparamsOnDemand) {
+      this.commHyperparams.call({
+        plot_id: this.props.data.plot_id,
+        python_path: pythonPath,
+        pipeline_digests: pipelines.map(pipeline => pipeline.pipeline_digest),
+      });
+      return null;
+    }
+    return computePrimitiveHyperparameterData(pipelines, pythonPath);
+  }
+
+  setPipelineHyperparams(pipeline, hyperparams) {
+    pipeline.steps.forEach((step, idx) => {
+      if (hyperparams[idx] !== null) {
+        step.hyperparams = hyperparams[idx];
+      }
+    });
+  }
+
+  requestPipelineHyperparams(pipeline) {
+    // Pipelines can be received again from commPipelinePages, so received hyperparameters are kept
+    const digest = pipeline.pipeline_digest;
+    if (!this.hyperparamsOnDemand) {
+      return;
+    }
+    if (digest in this.receivedHyperparams) {
+      this.setPipelineHyperparams(pipeline, this.receivedHyperparams[digest]);
+    } else if (!(digest in this.requestedHyperparams)) {
+      this.requestedHyperparams[digest] = true;
+      this.commHyperparams.call({plot_id: this.props.data.plot_id, pipeline_digest: digest});
+    }
+  }
+
+  receiveHyperparams(msg) {
+    if ('table' in msg) {
+      if (msg.python_path === this.state.expandedPrimitive) {
+        this.setState({expandedPrimitiveData: msg.table});
+      }
+    } else {
+      // Steps are shared by pipelines, selectedPipelines and hoveredPrimitive
+      this.receivedHyperparams[msg.pipeline_digest] = msg.hyperparams;
+      this.state.pipelines.forEach(pipeline => {
+        if (pipeline.pipeline_digest === msg.pipeline_digest) {
+          this.setPipelineHyperparams(pipeline, msg.hyperparams);
+        }
+      });
+      this.forceUpdate();
+    }
+  }
+
+  receivePipelinePage(msg) {
+    const rows = decodePipelineMatrixData(msg.rows).pipelines;
+    let newPipelines;
+    if (msg.replace) {
+      newPipelines = rows;
+    } else {
+      const loaded = {};
+      this.state.pipelines.forEach(pipeline => {loaded[pipeline.pipeline_digest] = true});
+      newPipelines = [...this.state.pipelines, ...rows.filter(pipeline => !(pipeline.pipeline_digest in loaded))];
+    }
+    const importances = this.computeImportances(newPipelines, this.state.metricRequest, this.state.removedPipelines);
+    const moduleNames = this.computeSortedModuleNames(this.state.moduleNames, this.state.sortColumnsBy, importances, this.props.data.infos);
+    this.setState({
+      pipelines: newPipelines,
+      loadedRows: msg.offset + rows.length,
+      paging: {...this.state.paging, total: msg.total},
+      importances,
+      moduleNames,
+    });
+  }
+
   componentDidCatch(error, info) {
     console.log(error);
     this.setState({selectedPipelines: []})
@@ -190,7 +352,8 @@ export class PipelineMatrixBundle extends Component {
       sortColumnsBy,
       sortRowsBy,
       powersetAnalysis,
-      highlightPowersetColumns
+      highlightPowersetColumns,
+      paging
     } = this.state;
     const {sortModuleBy, sortPipelineBy} = constants;
 
@@ -279,7 +442,7 @@ export class PipelineMatrixBundle extends Component {
     };
 
     const updateMetric = (pipelines) => {
-      const importances = computePrimitiveImportances(this.props.data.infos, pipelines, this.state.metricRequest);
+      const importances = this.computeImportances(pipelines, this.state.metricRequest, true);
 
       if (keepSorted) {
         if (sortColumnsBy === sortModuleBy.importance){
@@ -308,10 +471,10 @@ export class PipelineMatrixBundle extends Component {
       const importances = updateMetric(newPipelines);
       newModuleNames = this.computeSortedModuleNames(newModuleNames, this.state.sortColumnsBy, importances, this.props.data.infos);
       if (this.state.expandedPrimitive){
-        const expandedPrimitiveData = computePrimitiveHyperparameterData(newPipelines, this.state.expandedPrimitive);
+        const expandedPrimitiveData = this.computeExpandedPrimitiveData(newPipelines, this.state.expandedPrimitive);
         this.setState({expandedPrimitiveData});
       }
-      this.setState({pipelines: newPipelines, selectedPipelines: [], moduleNames: newModuleNames});
+      this.setState({pipelines: newPipelines, selectedPipelines: [], moduleNames: newModuleNames, removedPipelines: true});
     };
 
     return <div ref={ref=>{this.ref = ref}}>
@@ -353,7 +516,7 @@ export class PipelineMatrixBundle extends Component {
                   const found = this.state.selectedPipelines.find(selected => selected.pipeline_digest === pipeline.pipeline_digest);
                   return typeof found !== 'undefined';
                 });
-                this.commExportPipelines.call({pipelines: newPipelines});
+                this.callWithPipelines(this.commExportPipelines, newPipelines);
                 this.setState({exportedPipelineMessage: true});
               }
             },
@@ -364,7 +527,7 @@ export class PipelineMatrixBundle extends Component {
                   const found = this.state.selectedPipelines.find(selected => selected.pipeline_digest === pipeline.pipeline_digest);
                   return typeof found === 'undefined';
                 });
-                this.commExportPipelines.call({pipelines: newPipelines});
+                this.callWithPipelines(this.commExportPipelines, newPipelines);
                 this.setState({exportedPipelineMessage: true});
               }
             }
@@ -399,6 +562,7 @@ export class PipelineMatrixBundle extends Component {
               action: () => {
                 const newPipelines = this.computeSortedPipelines(this.state.pipelines, sortPipelineBy.pipeline_score, this.state.metricRequest);
                 this.setState({pipelines: newPipelines, sortRowsBy: sortPipelineBy.pipeline_score});
+                this.requestSortedRows(sortPipelineBy.pipeline_score, this.state.metricRequest);
               }
             },
             {
@@ -406,6 +570,7 @@ export class PipelineMatrixBundle extends Component {
               action: () => {
                 const newPipelines = this.computeSortedPipelines(this.state.pipelines, sortPipelineBy.pipeline_source, this.state.metricRequest);
                 this.setState({pipelines: newPipelines, sortRowsBy: sortPipelineBy.pipeline_source});
+                this.requestSortedRows(sortPipelineBy.pipeline_source, this.state.metricRequest);
               }
             }
           ]}
@@ -418,8 +583,7 @@ export class PipelineMatrixBundle extends Component {
             {
               name: 'Run',
               action: () => {
-                const scores = extractMetric(this.state.pipelines, this.state.metricRequest);
-                this.commPowersetAnalysis.call({pipelines: this.state.pipelines, scores});
+                this.callWithPipelines(this.commPowersetAnalysis, this.state.pipelines, {metric: this.state.metricRequest.name});
                 this.setState({expandedPrimitive: null, expandedPrimitiveData: null});
               }
             },
@@ -478,7 +642,7 @@ export class PipelineMatrixBundle extends Component {
           if (this.state.expandedPrimitive === python_path){
             this.setState({expandedPrimitive: null, expandedPrimitiveData: null});
           } else{
-            const expandedPrimitiveData = computePrimitiveHyperparameterData(this.state.pipelines, python_path);
+            const expandedPrimitiveData = this.computeExpandedPrimitiveData(this.state.pipelines, python_path);
             this.setState({expandedPrimitive: python_path, expandedPrimitiveData});
           }
         }}
@@ -498,15 +662,16 @@ export class PipelineMatrixBundle extends Component {
               if (newSelectedPipelines.length === this.state.selectedPipelines.length) {
                 newSelectedPipelines.push(selectedPipeline);
               }
-              this.commMergeGraph.call({pipelines: newSelectedPipelines});
+              this.callWithPipelines(this.commMergeGraph, newSelectedPipelines);
               this.setState({mergedGraph: null})
             }
             newSelectedPipelines.forEach(pipeline => {selectedPipelinesColorScale(pipeline.pipeline_digest)});
+            this.requestPipelineHyperparams(selectedPipeline);
             this.setState({selectedPipelines: newSelectedPipelines, selectedPrimitive: null, selectedPipelinesColorScale})
           }
         }
         metricRequestChange={metricRequest => {
-          const importances = computePrimitiveImportances(this.props.data.infos, this.state.pipelines, metricRequest);
+          const importances = this.computeImportances(this.state.pipelines, metricRequest, this.state.removedPipelines);
 
           if (keepSorted) {
             if (sortColumnsBy === sortModuleBy.importance){
@@ -524,6 +689,7 @@ export class PipelineMatrixBundle extends Component {
               const newPipelines = this.computeSortedPipelines(this.state.pipelines, sortPipelineBy.pipeline_source, metricRequest);
               this.setState({pipelines: newPipelines});
             }
+            this.requestSortedRows(sortRowsBy, metricRequest);
           }
           this.setState({metricRequest, importances});
         }}
@@ -535,6 +701,7 @@ export class PipelineMatrixBundle extends Component {
         moduleNames={this.state.moduleNames}
         onHover={(pipeline, moduleName, mouse) => {
           if (pipeline && moduleName){
+            this.requestPipelineHyperparams(pipeline);
             const step = pipeline.steps.find(step => step.primitive.python_path === moduleName);
             if (step){
               this.setState({hoveredPrimitive: step, tooltipPosition: mouse})
@@ -552,6 +719,12 @@ export class PipelineMatrixBundle extends Component {
           this.setState({pipelines: newPipelines});
         }}
       />
+      {paging && this.state.loadedRows < paging.total ?
+        <Button variant="outlined" size="small" onClick={() => {
+          this.requestPipelinePage(this.state.loadedRows, paging.page_size, false, sortRowsBy, this.state.metricRequest);
+        }}>
+          Load more pipelines ({this.state.loadedRows} of {paging.total} loaded)
+        </Button> : null}
       {tooltip}
       <div onMouseMove={()=>{this.cleanMouseOver()}}>
       {pipelineGraph}
@@ -565,6 +738,12 @@ export class PipelineMatrixBundle extends Component {
                   <CloseIcon fontSize="small" />
                 </IconButton>}
       />
+      <Snackbar open={this.state.commError !== null} onClose={() => {this.setState({commError: null})}}
+                message={this.state.commError}
+                action={<IconButton size="small" aria-label="close" color="inherit" onClick={() => this.setState({commError: null})}>
+                  <CloseIcon fontSize="small" />
+                </IconButton>}
+      />
     </div>
   }
 }
@@ -0,0 +1,54 @@
+// Decodes the compact pipeline matrix data created by PipelineProfiler/_compact_payload.py into the
+// {infos, module_types, pipelines: [pipeline, ...]} format used by PipelineMatrixBundle.
+// Scores and column indexes received through the comm api are TypedArrays, with NaN for missing scores.
+
+function decodeScores(metrics, values, normalized) {
+  const scores = [];
+  const score_map = {};
+  metrics.forEach((name, idx) => {
+    if (values[idx] === null || Number.isNaN(values[idx])) {
+      return;
+    }
+    const score = {metric: {metric: name}, value: values[idx]};
+    if (normalized[idx] !== null && !Number.isNaN(normalized[idx])) {
+      score.normalized = normalized[idx];
+    }
+    scores.push(score);
+    score_map[name] = score;
+  });
+  return {scores, score_map};
+}
+
+export function decodePipelineMatrixData(data) {
+  if (data.format !== 'compact') {
+    return data;
+  }
+  const compact = data.pipelines;
+  const columnNames = Object.keys(compact.columns);
+  const pipelines = [];
+  for (let i = 0; i < compact.n; i++) {
+    const pipeline = {};
+    columnNames.forEach(key => {
+      const column = compact.columns[key];
+      if (column.index[i] >= 0) {
+        pipeline[key] = column.values[column.index[i]];
+      }
+    });
+    pipeline.steps = compact.step_indices[i].map((stepIdx, j) => {
+      const step = Object.assign({}, compact.steps[stepIdx]);
+      step.primitive = compact.primitives[step.primitive];
+      const hyperparamIdx = compact.hyperparam_indices[i][j];
+      if (compact.hyperparams && hyperparamIdx >= 0) {
+        step.hyperparams = compact.hyperparams[hyperparamIdx];
+      }
+      return step;
+    });
+    const {scores, score_map} = decodeScores(compact.metrics, compact.values[i], compact.normalized[i]);
+    pipeline.scores = scores;
+    pipeline.score_map = score_map;
+    pipelines.push(pipeline);
+  }
+  const decoded = Object.assign({}, data, {pipelines});
+  delete decoded.format;
+  return decoded;
+}
@@ -5,6 +5,7 @@ import SolutionGraph from "./SolutionGraph"
 import {PipelineMatrix} from "./PipelineMatrix";
 import {PipelineMatrixBundle} from "./PipelineMatrixBundle";
 import MergedGraph from "./MergedGraph";
+import {decodePipelineMatrixData} from "./compactPayload";
 import "regenerator-runtime/runtime";
 
 export function renderMergedPipeline(divName, data){
@@ -32,6 +33,6 @@ export function renderPipelineMatrix(divName, data){
 
 export function renderPipelineMatrixBundle(divName, data){
 	ReactDOM.render(
-		<PipelineMatrixBundle data={data}/>
+		<PipelineMatrixBundle data={decodePipelineMatrixData(data)}/>
 	, select(divName).node());
 }
\ No newline at end of file
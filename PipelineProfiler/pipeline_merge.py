@@ -7,53 +7,182 @@
 
 import json
 import argparse
+import os
+import time
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+try:
+    from ._parallel import resolve_n_jobs, make_executor
+    from ._pipeline_store import write_pipeline_store
+    from ._timestamps import compute_durations
+except ImportError: # running as a script
+    from _parallel import resolve_n_jobs, make_executor
+    from _pipeline_store import write_pipeline_store
+    from _timestamps import compute_durations
 
-def merge_pipeline_files(pipelines_file, pipeline_runs_file, n=-1, verbose=False):
-    # Function that merges the pipelines file with the pipeline_runs file.
-    # Arguments:
-    # pipelines_file: Path to the pipeline_runs file. See http://metalearning.datadrivendiscovery.org/dumps
-    # pipeline_runs_file: Path to the pipelines file. See http://metalearning.datadrivendiscovery.org/dumps
-    # n: Number of merged pipelines to output. If n=-1, save all pipelines to the merged file
+CHUNK_SIZE = 2**24 # bytes of pipeline_runs_file parsed at a time
 
-    # adding pipelines to lookup table {<digest>: <data>}
-    print ("Adding pipelines to lookup table...")
-    pipelines = {}
-    with open(pipelines_file, "r", encoding="utf8") as f:
-        for line in f:
-            pipeline = json.loads(line)
-            pipelines[pipeline["digest"]] = pipeline
-    
-    # merging pipeline information with pipeline_runs
-    print ("Merging pipeline information with pipeline_runs_file (this might take a while)...")
-    merged = []
-    with open(pipeline_runs_file, "r",  encoding="utf8") as f:
+def index_pipelines_file(pipelines_file):
+    # Returns a lookup table {<digest>: <offset of the pipeline line in pipelines_file>}
+    index = {}
+    with open(pipelines_file, "rb") as f:
+        offset = 0
         for line in f:
-            if len(merged) == n:
-                break
+            index[json.loads(line)["digest"]] = offset
+            offset += len(line)
+    return index
+
+def find_chunk_offsets(path, chunk_size=CHUNK_SIZE):
+    # Splits the file in byte ranges [start, end) of about chunk_size bytes, aligned on line ends
+    total_bytes = os.path.getsize(path)
+    offsets = [0]
+    with open(path, "rb") as f:
+        while offsets[-1] < total_bytes:
+            f.seek(min(offsets[-1] + chunk_size, total_bytes))
+            f.readline()
+            offsets.append(min(f.tell(), total_bytes))
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def parse_runs_chunk(pipeline_runs_file, start, end, parse_all=False):
+    # Parses the PRODUCE pipeline runs in the byte range [start, end) of pipeline_runs_file.
+    # Lines that do not contain "PRODUCE" are skipped without parsing them, unless parse_all is set (to report the
+    # malformed lines).
+    # Returns the number of lines in the chunk and a list with, for every PRODUCE run, either the tuple
+    # (pipeline digest, problem, start, end, scores, prediction time in seconds) or the repr of the exception raised
+    # while reading it.
+    runs = []
+    n_lines = 0
+    with open(pipeline_runs_file, "rb") as f:
+        f.seek(start)
+        for line in f.read(end - start).splitlines():
+            n_lines += 1
+            if not parse_all and b'"PRODUCE"' not in line:
+                continue
             try:
                 run = json.loads(line)
                 if run['run']['phase']!='PRODUCE':
                     continue
-                pipeline = pipelines[run["pipeline"]["digest"]]
-                data = {
-                    'pipeline_id': pipeline['id'],
-                    'pipeline_digest': pipeline['digest'],
-                    'pipeline_source': pipeline['source'],
-                    'created': pipeline['created'],
-                    'inputs': pipeline['inputs'],
-                    'outputs': pipeline['outputs'],
-                    'problem': run['problem'],
-                    'start': run['start'],
-                    'end': run['end'],
-                    'steps': pipeline['steps'],
-                    'scores': run['run']['results']['scores']
-                }
-                merged.append(data)
+                runs.append((run["pipeline"]["digest"], run['problem'], run['start'], run['end'], run['run']['results']['scores']))
             except Exception as e:
-                if (verbose):
-                    print (repr(e))
+                runs.append(repr(e))
+    # prediction times are computed in bulk
+    timed = [idx for idx, run in enumerate(runs) if not isinstance(run, str)]
+    try:
+        durations = compute_durations([runs[idx][2] for idx in timed], [runs[idx][3] for idx in timed])
+    except Exception:
+        durations = [None] * len(timed)
+    for idx, duration in zip(timed, durations):
+        runs[idx] = runs[idx] + (duration,)
+    return n_lines, runs
+
+def iter_parsed_runs_chunks(pipeline_runs_file, n_jobs=None, parse_all=False):
+    # Yields (chunk end offset, parse_runs_chunk result) for every chunk of pipeline_runs_file, in order.
+    # Chunks are parsed in a process pool of n_jobs workers (see _parallel.py), at most 2 chunks per worker at a time.
+    chunks = find_chunk_offsets(pipeline_runs_file)
+    n_workers = resolve_n_jobs(n_jobs, len(chunks))
+    if n_workers is None:
+        for start, end in chunks:
+            yield end, parse_runs_chunk(pipeline_runs_file, start, end, parse_all)
+        return
+    with make_executor(n_workers) as executor:
+        pending = deque()
+        chunks = iter(chunks)
+        try:
+            for start, end in islice(chunks, 2 * n_workers):
+                pending.append((end, executor.submit(parse_runs_chunk, pipeline_runs_file, start, end, parse_all)))
+            while pending:
+                end, future = pending.popleft()
+                for start, next_end in islice(chunks, 1):
+                    pending.append((next_end, executor.submit(parse_runs_chunk, pipeline_runs_file, start, next_end, parse_all)))
+                yield end, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def iter_merged_pipeline_runs(pipelines_file, pipeline_runs_file, n=-1, verbose=False, cache_size=256, progress_every=0, n_jobs=None):
+    # Generator version of merge_pipeline_files that yields merged pipeline runs one by one.
+    # Only the offsets of the pipelines are kept in memory. Pipelines are read from the file when needed, and the
+    # `cache_size` most recently used ones are cached. With cache_size=None, every pipeline read is kept, so the
+    # merged runs of a pipeline share the same steps (use it when all merged runs are kept in memory).
+    # verbose: Print the errors of the malformed lines (all lines are parsed, not only the PRODUCE runs).
+    # progress_every: Print progress every `progress_every` pipeline runs read. If 0, progress is not printed.
+    # n_jobs: Number of processes parsing pipeline_runs_file. See iter_parsed_runs_chunks.
+    print ("Indexing pipelines file...")
+    index = index_pipelines_file(pipelines_file)
+
+    with open(pipelines_file, "rb") as pipelines_f:
+        @lru_cache(maxsize=cache_size)
+        def load_pipeline(digest):
+            pipelines_f.seek(index[digest])
+            return json.loads(pipelines_f.readline())
+
+        print ("Merging pipeline information with pipeline_runs_file (this might take a while)...")
+        total_bytes = os.path.getsize(pipeline_runs_file)
+        start_time = time.time()
+        n_read = 0
+        n_merged = 0
+        for chunk_end, (n_lines, runs) in iter_parsed_runs_chunks(pipeline_runs_file, n_jobs, parse_all=verbose):
+            for run in runs:
+                if n_merged == n:
+                    break
+                try:
+                    if isinstance(run, str):
+                        raise ValueError(run)
+                    digest, problem, start, end, scores, prediction_time = run
+                    pipeline = load_pipeline(digest)
+                    data = {
+                        'pipeline_id': pipeline['id'],
+                        'pipeline_digest': pipeline['digest'],
+                        'pipeline_source': pipeline['source'],
+                        'created': pipeline['created'],
+                        'inputs': pipeline['inputs'],
+                        'outputs': pipeline['outputs'],
+                        'problem': problem,
+                        'start': start,
+                        'end': end,
+                        'steps': pipeline['steps'],
+                        'scores': scores
+                    }
+                    if prediction_time is not None:
+                        data['prediction_time'] = prediction_time
+                except Exception as e:
+                    if (verbose):
+                        print (run if isinstance(run, str) else repr(e))
+                    continue
+                n_merged += 1
+                yield data
+            if n_merged == n:
+                break
+            if progress_every and (n_read + n_lines) // progress_every > n_read // progress_every:
+                elapsed = max(time.time() - start_time, 1e-9)
+                print ("{} runs read ({:.1f}%), {} merged, {:.0f} runs/s, {:.1f} MB/s".format(
+                    n_read + n_lines, 100 * chunk_end / max(total_bytes, 1), n_merged, (n_read + n_lines) / elapsed, chunk_end / elapsed / 2**20))
+            n_read += n_lines
+        if progress_every:
+            print ("{} runs read, {} merged in {:.1f}s".format(n_read, n_merged, time.time() - start_time))
         print ("Done.")
-    return merged
+
+def merge_pipeline_files(pipelines_file, pipeline_runs_file, n=-1, verbose=False, n_jobs=None):
+    # Function that merges the pipelines file with the pipeline_runs file.
+    # Arguments:
+    # pipelines_file: Path to the pipeline_runs file. See http://metalearning.datadrivendiscovery.org/dumps
+    # pipeline_runs_file: Path to the pipelines file. See http://metalearning.datadrivendiscovery.org/dumps
+    # n: Number of merged pipelines to output. If n=-1, save all pipelines to the merged file
+    # n_jobs: Number of processes parsing pipeline_runs_file. If n_jobs=-1, use all CPUs
+    return list(iter_merged_pipeline_runs(pipelines_file, pipeline_runs_file, n=n, verbose=verbose, cache_size=None, n_jobs=n_jobs))
+
+def stream_merge_pipeline_files(pipelines_file, pipeline_runs_file, output_file, n=-1, verbose=False, progress_every=10000, n_jobs=None):
+    # Same as merge_pipeline_files, but writes the merged pipelines to output_file as JSON Lines (one pipeline per
+    # line) as they are produced, so memory usage does not grow with the size of the dumps.
+    # Returns the number of merged pipelines.
+    n_merged = 0
+    with open(output_file, "w", encoding="utf8") as out:
+        for data in iter_merged_pipeline_runs(pipelines_file, pipeline_runs_file, n=n, verbose=verbose, progress_every=progress_every, n_jobs=n_jobs):
+            out.write(json.dumps(data))
+            out.write("\n")
+            n_merged += 1
+    return n_merged
 
 
 
@@ -64,7 +193,15 @@ if __name__ == "__main__":
     parser.add_argument("output_file", help="Path to output file.", type=str)
     parser.add_argument("-n", "--number_pipelines", help="Number of pipelines to save to the file. If n=-1, save all pipelines to the merged file.", type=int, default=-1)
     parser.add_argument("-v", "--verbose", help="Increase output verbosity (show json key errors)", action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of processes parsing the pipeline_runs file. If -1, use all CPUs.", type=int, default=1)
+    parser.add_argument("-s", "--stream", help="Write the merged pipelines as JSON Lines while they are merged, with bounded memory usage.", action="store_true")
+    parser.add_argument("--sqlite", help="Write the merged pipelines to a SQLite pipeline store indexed by problem and digest (see _pipeline_store.py), with bounded memory usage.", action="store_true")
     args = parser.parse_args()
-    d = merge_pipeline_files(args.pipelines_file, args.pipeline_runs_file, n = args.number_pipelines, verbose=args.verbose)
-    with open(args.output_file, "w", encoding="utf8") as f:
-        json.dump(d, f)
\ No newline at end of file
+    if args.sqlite:
+        write_pipeline_store(args.output_file, iter_merged_pipeline_runs(args.pipelines_file, args.pipeline_runs_file, n = args.number_pipelines, verbose=args.verbose, progress_every=10000, n_jobs=args.jobs))
+    elif args.stream:
+        stream_merge_pipeline_files(args.pipelines_file, args.pipeline_runs_file, args.output_file, n = args.number_pipelines, verbose=args.verbose, n_jobs=args.jobs)
+    else:
+        d = merge_pipeline_files(args.pipelines_file, args.pipeline_runs_file, n = args.number_pipelines, verbose=args.verbose, n_jobs=args.jobs)
+        with open(args.output_file, "w", encoding="utf8") as f:
+            json.dump(d, f)
\ No newline at end of file
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Compares the size and encoding/decoding time of numeric arrays in comm replies, sent as JSON numbers, as binary
+# buffers (Jupyter) and as base64 strings (Colab). Decoding is measured in Python (json.loads / np.frombuffer), as an
+# estimate of the work of the javascript CommAPI.
+#
+# python benchmarks/comm_buffer_benchmark.py -n 100000 1000000
+
+import argparse
+import base64
+import json
+import time
+import numpy as np
+from PipelineProfiler._comm_api import encode_reply
+
+
+def encode_json(reply):
+    payload = json.dumps({key: value.tolist() for key, value in reply.items()})
+    return len(payload), lambda: {key: np.array(value) for key, value in json.loads(payload).items()}
+
+
+def encode_buffers(reply):
+    data, buffers = encode_reply(reply)
+    payload = json.dumps(data)
+    frames = [bytes(buffer) for buffer in buffers]
+    def decode():
+        decoded = json.loads(payload)
+        return {key: np.frombuffer(frames[value['__ndarray__']['buffer']], dtype=value['__ndarray__']['dtype'])
+                for key, value in decoded.items()}
+    return len(payload) + sum(len(frame) for frame in frames), decode
+
+
+def encode_base64(reply):
+    data, _ = encode_reply(reply, binary=False)
+    payload = json.dumps(data)
+    def decode():
+        decoded = json.loads(payload)
+        return {key: np.frombuffer(base64.b64decode(value['__ndarray__']['base64']), dtype=value['__ndarray__']['dtype'])
+                for key, value in decoded.items()}
+    return len(payload), decode
+
+
+def measure(name, encode, reply, repeat):
+    best_encode = best_decode = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size, decode = encode(reply)
+        best_encode = min(best_encode, time.perf_counter() - start)
+        start = time.perf_counter()
+        decode()
+        best_decode = min(best_decode, time.perf_counter() - start)
+    print("{:<10} {:>10.2f} MB {:>10.3f} s {:>10.3f} s".format(name, size / 2**20, best_encode, best_decode))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number_elements", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+    rng = np.random.RandomState(0)
+    for n in args.number_elements:
+        reply = {'scores': rng.rand(n), 'indices': rng.randint(0, 1000, n).astype(np.int32)}
+        print("{} float64 + {} int32 elements (best of {})        size     encode     decode".format(n, n, args.repeat))
+        measure("json", encode_json, reply, args.repeat)
+        measure("buffers", encode_buffers, reply, args.repeat)
+        measure("base64", encode_base64, reply, args.repeat)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Compares the size and serialization time of the pipeline matrix payload, in the full and compact formats.
+# Pipelines are copies of the heartstatlog demo data with distinct digests.
+#
+# python benchmarks/payload_benchmark.py -n 5000
+
+import argparse
+import copy
+import json
+import time
+import PipelineProfiler
+from PipelineProfiler._plot_pipeline_matrix import prepare_data_pipeline_matrix
+from PipelineProfiler._compact_payload import encode_compact_payload
+
+
+def make_pipelines(n):
+    demo = PipelineProfiler.get_heartstatlog_data()
+    pipelines = []
+    for idx in range(n):
+        pipeline = copy.deepcopy(demo[idx % len(demo)])
+        pipeline['pipeline_digest'] = '{}-{}'.format(pipeline['pipeline_digest'], idx)
+        pipeline['pipeline_id'] = '{}-{}'.format(pipeline['pipeline_id'], idx)
+        pipelines.append(pipeline)
+    return pipelines
+
+
+def measure(name, encode, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = json.dumps(encode())
+        best = min(best, time.perf_counter() - start)
+    print("{:<28} {:>10.2f} MB {:>10.3f} s".format(name, len(payload) / 2**20, best))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number_pipelines", type=int, default=5000)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+    pipelines = make_pipelines(args.number_pipelines)
+    print("{} pipelines (prepare_data_pipeline_matrix + encoding + json.dumps, best of {})".format(len(pipelines), args.repeat))
+    measure("full", lambda: prepare_data_pipeline_matrix(pipelines), args.repeat)
+    measure("compact", lambda: encode_compact_payload(prepare_data_pipeline_matrix(pipelines)), args.repeat)
+    measure("compact, no hyperparams", lambda: encode_compact_payload(prepare_data_pipeline_matrix(pipelines), include_hyperparams=False), args.repeat)
@@ -0,0 +1,118 @@
+import networkx as nx
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+import PipelineProfiler
+from PipelineProfiler._graph_matching import (ContractionGraph, compute_edit_cost_matrix, compute_node_equivalence,
+                                              compute_node_similarity_matrix, merge_graphs, merge_multiple_graphs,
+                                              pipeline_to_graph, unique_node_name)
+
+
+def reference_node_equivalence(g1, g2):
+    # compute_node_equivalence checking each contraction with networkx (nx.contracted_nodes and find_cycle on a copy of
+    # the union graph), as before the incremental ContractionGraph
+    helper_graph = nx.union(g1, g2, rename=('g1-', 'g2-'))
+    edit_cost_matrix = compute_edit_cost_matrix(compute_node_similarity_matrix(g1, g2), 0.4, 0.4)
+    rows, cols = linear_sum_assignment(edit_cost_matrix)
+    nodes_g1 = list(g1.nodes)
+    nodes_g2 = list(g2.nodes)
+    equivalence_g1, equivalence_g2 = {}, {}
+    for row, col in zip(rows, cols):
+        if row < len(nodes_g1) and col < len(nodes_g2):
+            eq_g1, eq_g2 = nodes_g1[row], nodes_g2[col]
+            merged_helper = nx.contracted_nodes(helper_graph, 'g1-' + eq_g1, 'g2-' + eq_g2, self_loops=False)
+            try:
+                nx.find_cycle(merged_helper)
+            except nx.NetworkXNoCycle:
+                equivalence_g1[eq_g1] = eq_g2
+                equivalence_g2[eq_g2] = eq_g1
+                helper_graph = merged_helper
+    return equivalence_g1, equivalence_g2
+
+
+def make_random_pipeline(rng, digest):
+    # Random DAG pipeline, steps can have several arguments and list arguments
+    steps = []
+    for idx in range(rng.randint(1, 8)):
+        references = ['inputs.0'] + ['steps.{}.produce'.format(previous) for previous in range(idx)]
+        arguments = {}
+        for argument in range(rng.randint(1, 3)):
+            data = list(rng.choice(references, rng.randint(1, 3)))
+            arguments['input{}'.format(argument)] = {'data': data if len(data) > 1 or rng.rand() < 0.5 else data[0]}
+        python_path = 'd3m.primitives.family{}.primitive{}.Common'.format(rng.randint(3), rng.randint(4))
+        steps.append({'primitive': {'python_path': python_path, 'name': python_path}, 'arguments': arguments})
+    return {'pipeline_digest': digest, 'steps': steps,
+            'outputs': [{'data': 'steps.{}.produce'.format(len(steps) - 1)}]}
+
+
+def assert_dag_order(graph):
+    # The maintained order is a topological order of the contracted graph
+    for node in range(len(graph.parent)):
+        if graph.find(node) == node:
+            assert all(graph.order[node] < graph.order[dest] for dest in graph.successors[node])
+        else:
+            assert not graph.successors[node] and not graph.predecessors[node]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_contraction_graph_matches_networkx(seed):
+    rng = np.random.RandomState(seed)
+    n_nodes = rng.randint(2, 15)
+    edges = [(i, j) for i in range(n_nodes) for j in range(i + 1, n_nodes) if rng.rand() < 0.25]
+    permutation = rng.permutation(n_nodes) # node ids are not in topological order
+    edges = [(int(permutation[i]), int(permutation[j])) for i, j in edges]
+    graph = ContractionGraph(n_nodes, edges)
+    reference = nx.DiGraph()
+    reference.add_nodes_from(range(n_nodes))
+    reference.add_edges_from(edges)
+    representative = list(range(n_nodes))
+    for _ in range(2 * n_nodes):
+        u, v = rng.randint(n_nodes, size=2)
+        ru, rv = representative[u], representative[v]
+        if ru == rv:
+            expected = True
+        else:
+            contracted = nx.contracted_nodes(reference, ru, rv, self_loops=False)
+            expected = nx.is_directed_acyclic_graph(contracted)
+            if expected:
+                reference = contracted
+                representative = [ru if r == rv else r for r in representative]
+        assert graph.contract(u, v) == expected
+        assert_dag_order(graph)
+    for node in range(n_nodes):
+        assert graph.find(node) == representative[node]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_node_equivalence_matches_reference_on_random_pipelines(seed):
+    rng = np.random.RandomState(seed)
+    graphs = [pipeline_to_graph(make_random_pipeline(rng, '{}'.format(idx))) for idx in range(8)]
+    merged = graphs[0]
+    for graph in graphs[1:]:
+        assert compute_node_equivalence(merged, graph) == reference_node_equivalence(merged, graph)
+        merged = merge_graphs(merged, graph)
+
+
+def test_node_equivalence_matches_reference_on_demo_data():
+    graphs = [pipeline_to_graph(pipeline) for pipeline in PipelineProfiler.get_heartstatlog_data()]
+    merged = graphs[0]
+    for graph in graphs[1:]:
+        assert compute_node_equivalence(merged, graph) == reference_node_equivalence(merged, graph)
+        merged = merge_graphs(merged, graph)
+
+
+def test_unique_node_name():
+    used_names = {'G2.steps.4'}
+    assert unique_node_name('G2.', 'steps.4', used_names) == 'G2.G2.steps.4'
+    assert unique_node_name('G2.', 'steps.4', used_names) == 'G2.G2.G2.steps.4'
+    assert unique_node_name('G1.', 'steps.4', used_names) == 'G1.steps.4'
+
+
+def test_merged_demo_pipelines_are_acyclic():
+    # Unmatched nodes used to take the names of matched nodes of previous merges, merging unrelated nodes
+    graphs = [pipeline_to_graph(pipeline) for pipeline in PipelineProfiler.get_heartstatlog_data()[:32]]
+    merged = merge_multiple_graphs(graphs)
+    assert nx.is_directed_acyclic_graph(merged)
+    assert nx.number_of_selfloops(merged) == 0
+    # every step of every pipeline is in exactly one node
+    assert sum(len(merged.nodes[node]['data']) for node in merged.nodes) == sum(len(graph) for graph in graphs)
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from networkx.readwrite import json_graph
+import PipelineProfiler
+from PipelineProfiler._merge_cache import merge_pipelines, clear_merge_cache, merge_cache
+
+
+def merged_data(pipelines, tree=False):
+    return json_graph.node_link_data(merge_pipelines(pipelines, tree=tree))
+
+
+def test_warm_merge_equals_cold_merge():
+    pipelines = PipelineProfiler.get_heartstatlog_data()
+    clear_merge_cache()
+    cold = merged_data(pipelines[:12])
+    clear_merge_cache()
+    merge_pipelines(pipelines[:10])
+    merge_pipelines(pipelines[:11])
+    assert merged_data(pipelines[:12]) == cold
+
+
+def test_warm_tree_merge_equals_cold_tree_merge():
+    pipelines = PipelineProfiler.get_heartstatlog_data()
+    clear_merge_cache()
+    cold = merged_data(pipelines[:12], tree=True)
+    clear_merge_cache()
+    merge_pipelines(pipelines[:10], tree=True)
+    merge_pipelines(pipelines[:12])
+    assert merged_data(pipelines[:12], tree=True) == cold
+
+
+def test_prefix_lookup_counts_one_hit():
+    pipelines = PipelineProfiler.get_heartstatlog_data()
+    clear_merge_cache()
+    merge_pipelines(pipelines[:10])
+    before = merge_cache.info()
+    merge_pipelines(pipelines[:12])
+    after = merge_cache.info()
+    assert (after['hits'] - before['hits'], after['misses'] - before['misses']) == (1, 0)
+
+
+def test_concurrent_merges_equal_serial_merges():
+    pipelines = PipelineProfiler.get_heartstatlog_data()
+    selections = [pipelines[:k] for k in range(2, 20)] * 4
+    clear_merge_cache()
+    serial = [merged_data(selection) for selection in selections]
+    clear_merge_cache()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(merged_data, selections)) == serial
+
+
+def test_pipelines_with_the_same_digests_are_not_shared():
+    # import_autosklearn gives the digests '0', '1', ... to the pipelines of every run
+    pipelines = copy.deepcopy(PipelineProfiler.get_heartstatlog_data())
+    first, second = pipelines[:6], pipelines[6:12]
+    for idx, (a, b) in enumerate(zip(first, second)):
+        a['pipeline_digest'] = b['pipeline_digest'] = '{}'.format(idx)
+    clear_merge_cache()
+    cold = merged_data(second)
+    cold_tree = merged_data(second, tree=True)
+    clear_merge_cache()
+    merged_first = merge_pipelines(first)
+    merge_pipelines(first, tree=True)
+    merge_pipelines(first[:3])
+    assert merge_pipelines(second) is not merged_first
+    assert merged_data(second) == cold
+    assert merged_data(second, tree=True) == cold_tree
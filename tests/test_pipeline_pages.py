@@ -0,0 +1,45 @@
+import copy
+import numpy as np
+import PipelineProfiler
+from PipelineProfiler._pipeline_pages import SORT_BY_SCORE, SORT_BY_SOURCE, compute_row_orders, extract_metric_names
+from PipelineProfiler._plot_pipeline_matrix import compute_metric_map, copy_pipeline_records, rename_pipelines
+
+
+def make_pipelines():
+    # Demo pipelines with an ACCURACY score missing its normalized value, or NaN, in some pipelines
+    pipelines = copy_pipeline_records(copy.deepcopy(PipelineProfiler.get_heartstatlog_data()))
+    rng = np.random.RandomState(0)
+    for idx, pipeline in enumerate(pipelines):
+        score = {'metric': {'metric': 'ACCURACY'}, 'value': 0.8}
+        if idx % 3 == 1:
+            score['normalized'] = float('nan')
+        elif idx % 3 == 2:
+            score['normalized'] = float(rng.randint(5)) / 4 # ties
+        pipeline['scores'].append(score)
+    compute_metric_map(pipelines)
+    rename_pipelines(pipelines)
+    return pipelines
+
+
+def reference_score_order(pipelines, metric):
+    # Descending normalized score, rows without a normalized score last, ties in input order
+    def key(idx):
+        score = pipelines[idx]['score_map'][metric].get('normalized')
+        missing = score is None or np.isnan(score)
+        return (missing, 0 if missing else -score)
+    return sorted(range(len(pipelines)), key=key)
+
+
+def test_row_orders_with_missing_normalized_scores():
+    pipelines = make_pipelines()
+    metrics = extract_metric_names(pipelines)
+    assert metrics == ['F1', 'ACCURACY']
+    orders = compute_row_orders(pipelines, metrics)
+    for metric in metrics:
+        score_order = orders[(SORT_BY_SCORE, metric)].tolist()
+        assert score_order == reference_score_order(pipelines, metric)
+        # grouped by source, sources in order of their first row by score
+        sources = [pipelines[idx]['pipeline_source']['name'].split("#")[0] for idx in score_order]
+        source_rank = {source: sources.index(source) for source in sources}
+        expected = sorted(score_order, key=lambda idx: source_rank[pipelines[idx]['pipeline_source']['name'].split("#")[0]])
+        assert orders[(SORT_BY_SOURCE, metric)].tolist() == expected
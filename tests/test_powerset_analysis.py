@@ -0,0 +1,162 @@
+from itertools import chain, combinations
+import copy
+import math
+import warnings
+import numpy as np
+import pytest
+from scipy.stats import pointbiserialr
+import PipelineProfiler
+from PipelineProfiler._powerset_analysis import (compute_group_importance, compute_primitive_importances,
+                                                extract_primitive_matrix, extract_scores)
+from PipelineProfiler._plot_pipeline_matrix import compute_metric_map, prepare_data_pipeline_matrix
+
+
+def reference_group_importance(pipelines, scores, up_to_k):
+    # Exhaustive search with scipy's point-biserial correlation (implementation before the batched rewrite)
+    primitive_matrix, primitives = extract_primitive_matrix(pipelines)
+    importances = {}
+    for k in range(1, up_to_k + 1):
+        for columns in combinations(range(len(primitives)), k):
+            used_all = np.prod(primitive_matrix[:, list(columns)], axis=1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # constant inputs, the importance is 0
+                importance, _ = pointbiserialr(used_all, scores)
+            importances[frozenset(primitives[list(columns)])] = 0 if np.isnan(importance) else importance
+    kept = {}
+    for group, importance in importances.items():
+        subgroups = chain(*[combinations(group, size) for size in range(1, len(group))])
+        if len(group) > 1 and all(abs(importances[frozenset(subgroup)]) < abs(importance) for subgroup in subgroups):
+            kept[group] = importance
+    return kept
+
+
+def as_dict(groups):
+    return {frozenset(group['group']): group['importance'] for group in groups}
+
+
+def make_random_pipelines(rng, n_pipelines, n_primitives):
+    pipelines = []
+    for _ in range(n_pipelines):
+        used = rng.randint(0, n_primitives, rng.randint(1, 6)) # primitives can be repeated in a pipeline
+        pipelines.append({'steps': [{'primitive': {'python_path': 'd3m.primitives.p{}'.format(p)}} for p in used]})
+    return pipelines
+
+
+def assert_same_groups(groups, expected):
+    groups = as_dict(groups)
+    assert set(groups) == set(expected)
+    for group, importance in expected.items():
+        assert groups[group] == pytest.approx(importance, abs=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_group_importance_matches_reference(seed):
+    rng = np.random.RandomState(seed)
+    pipelines = make_random_pipelines(rng, rng.randint(2, 25), rng.randint(2, 8))
+    # ties in the scores, and constant scores for some seeds
+    scores = rng.randint(0, 4, len(pipelines)) / 4 if seed % 3 else rng.rand(len(pipelines))
+    if seed % 7 == 0:
+        scores = np.ones(len(pipelines))
+    expected = reference_group_importance(pipelines, scores, 3)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3), expected)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3, min_support=1), expected)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3, min_support=1, n_jobs=2), expected)
+
+
+def test_group_importance_matches_reference_on_demo_data():
+    pipelines = PipelineProfiler.get_heartstatlog_data()
+    scores = extract_scores(pipelines)
+    expected = reference_group_importance(pipelines, scores, 3)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3), expected)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3, min_support=1), expected)
+    assert_same_groups(compute_group_importance(pipelines, scores, 3, n_jobs=2), expected)
+
+
+def d3_values(values):
+    # d3-array skips undefined, null and NaN values
+    return [value for value in values if value is not None and not math.isnan(value)]
+
+
+def d3_mean(values):
+    values = d3_values(values)
+    return sum(values) / len(values) if values else float('nan')
+
+
+def d3_deviation(values):
+    # Welford's algorithm, as d3.variance
+    count, mean, sum_squares = 0, 0, 0
+    for value in d3_values(values):
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        sum_squares += delta * (value - mean)
+    return math.sqrt(sum_squares / (count - 1)) if count > 1 else float('nan')
+
+
+def reference_primitive_importances(pipelines, metric):
+    # computePrimitiveImportances in js/helpers.js: extractMetric(..., NORMALIZED) gives 0 for a missing metric and
+    # undefined for a missing normalized value
+    scores = [pipeline['score_map'][metric].get('normalized') if metric in pipeline['score_map'] else 0
+              for pipeline in pipelines]
+    primitives = {step['primitive']['python_path'] for pipeline in pipelines for step in pipeline['steps']}
+    n = len(scores)
+    importances = {}
+    for primitive in primitives:
+        uses = [any(step['primitive']['python_path'] == primitive for step in pipeline['steps']) for pipeline in pipelines]
+        used = [score for score, use in zip(scores, uses) if use]
+        not_used = [score for score, use in zip(scores, uses) if not use]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = ((d3_mean(used) - d3_mean(not_used)) / np.float64(d3_deviation(scores))) * \
+                math.sqrt(len(used) * len(not_used) / (n * (n - 1)))
+        importances[primitive] = float(correlation) if np.isfinite(correlation) else 0
+    return importances
+
+
+def assert_same_importances(pipelines):
+    compute_metric_map(pipelines)
+    metrics = sorted({metric for pipeline in pipelines for metric in pipeline['score_map']})
+    importances = compute_primitive_importances(pipelines, metrics)
+    for metric in metrics:
+        expected = reference_primitive_importances(pipelines, metric)
+        assert set(importances[metric]) == set(expected)
+        for primitive, importance in expected.items():
+            assert importances[metric][primitive] == pytest.approx(importance, abs=1e-9)
+    return importances
+
+
+def test_primitive_importances_match_javascript_on_demo_data():
+    pipelines = copy.deepcopy(PipelineProfiler.get_heartstatlog_data())
+    # scores without normalized value, with NaN or null normalized values, and a metric missing from some pipelines
+    pipelines[0]['scores'][0]['normalized'] = float('nan')
+    pipelines[1]['scores'].append({'metric': {'metric': 'ACCURACY'}, 'value': 0.8})
+    pipelines[2]['scores'].append({'metric': {'metric': 'ACCURACY'}, 'value': 0.7, 'normalized': None})
+    for pipeline in pipelines[3:20]:
+        pipeline['scores'].append({'metric': {'metric': 'ACCURACY'}, 'value': 0.5, 'normalized': len(pipeline['steps']) / 10})
+    importances = assert_same_importances(pipelines)
+    assert any(importance != 0 for importance in importances['F1'].values())
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_primitive_importances_match_javascript(seed):
+    rng = np.random.RandomState(seed)
+    pipelines = make_random_pipelines(rng, rng.randint(1, 15), rng.randint(1, 6))
+    for pipeline in pipelines:
+        pipeline['scores'] = []
+        for metric in ['A', 'B']:
+            draw = rng.rand()
+            if draw < 0.15:
+                continue # metric missing, its score is 0
+            score = {'metric': {'metric': metric}, 'value': 1}
+            if draw < 0.25:
+                score['normalized'] = float('nan')
+            elif draw > 0.35: # normalized value missing otherwise
+                score['normalized'] = float(rng.randint(0, 4)) / 4 if seed % 2 else float(rng.rand())
+            pipeline['scores'].append(score)
+    assert_same_importances(pipelines)
+
+
+def test_prepare_data_with_missing_normalized_scores():
+    pipelines = copy.deepcopy(PipelineProfiler.get_heartstatlog_data())
+    pipelines[5]['scores'].append({'metric': {'metric': 'ACCURACY'}, 'value': 0.8})
+    data = prepare_data_pipeline_matrix(pipelines)
+    assert set(data['importances']) == {'F1', 'ACCURACY', 'PRED TIME (s)'}